@@ -21,6 +21,7 @@ import os
 import string
 import pickle
 from utils.dataset_utils import get_dataset_generative, get_loader
+from utils.checkpoint import AsyncCheckpointWriter
 # from undecorated import undecorated
 # from types import MethodType
 
@@ -43,6 +44,13 @@ class DistributedRunner(SingleRunner):
         # self.num_alternations = self.args.epochs // (self.args.id_epochs + self.args.rec_epochs)
         (self.id_optimizer, self.id_scheduler, 
         self.rec_optimizer, self.rec_scheduler) = self.create_optimizer_and_scheduler_2()
+        # rank 0 writes checkpoints on a background thread, so other ranks do not wait at the next barrier;
+        # ID generator and recommender checkpoints are rotated separately
+        # --keep_last_checkpoints 0 keeps all, which the writer spells as keep_last=None
+        keep_last = self.args.keep_last_checkpoints or None
+        self.checkpoint_writers = {
+            group: AsyncCheckpointWriter(keep_last=keep_last) for group in ['gen', 'rec']
+        } if self.rank == 0 else None
         # self.get_testloader(regenerate=False, phase=0)
 
     def create_optimizer_and_scheduler_2(self):
@@ -241,8 +249,8 @@ class DistributedRunner(SingleRunner):
                     # save model
                     if self.rank == 0:
                         cur_path = os.path.join(self.args.model_path, f"model_gen_phase_{alter+1}_epoch_{id_epoch+1}.pt")
-                        torch.save(self.model_gen.module.state_dict(), cur_path)
-                        logging.info(f"Save the current ID model to {cur_path}")
+                        self.save_checkpoint(self.model_gen.module, self.id_optimizer, self.id_scheduler, cur_path, 'gen')
+                        logging.info(f"Queued saving the current ID model to {cur_path}")
 
                     if self.rank == 0:
                         train_epoch_loss = sum(losses)/len(losses)
@@ -329,8 +337,8 @@ class DistributedRunner(SingleRunner):
                     # save model
                     if self.rank == 0 and (rec_epoch+1) % 10 == 0:
                         cur_path = os.path.join(self.args.model_path, f"model_rec_phase_{alter+1}_epoch_{rec_epoch+1}.pt")
-                        torch.save(self.model_rec.module.state_dict(), cur_path)
-                        logging.info(f"Save the current rec model to {cur_path}")
+                        self.save_checkpoint(self.model_rec.module, self.rec_optimizer, self.rec_scheduler, cur_path, 'rec')
+                        logging.info(f"Queued saving the current rec model to {cur_path}")
 
                     if self.rank == 0:
                         train_epoch_loss = sum(losses)/len(losses)
@@ -419,8 +427,8 @@ class DistributedRunner(SingleRunner):
                     # save model
                     if self.rank == 0 and (rec_epoch+1) % 10 == 0:
                         cur_path = os.path.join(self.args.model_path, f"model_rec_phase_{alter+1}_epoch_{rec_epoch+1}.pt")
-                        torch.save(self.model_rec.module.state_dict(), cur_path)
-                        logging.info(f"Save the current rec model to {cur_path}")
+                        self.save_checkpoint(self.model_rec.module, self.rec_optimizer, self.rec_scheduler, cur_path, 'rec')
+                        logging.info(f"Queued saving the current rec model to {cur_path}")
 
                     if self.rank == 0:
                         train_epoch_loss = sum(losses)/len(losses)
@@ -548,8 +556,8 @@ class DistributedRunner(SingleRunner):
                     # save model
                     if self.rank == 0:
                         cur_path = os.path.join(self.args.model_path, f"model_gen_phase_{alter+1}_epoch_{id_epoch+1}.pt")
-                        torch.save(self.model_gen.module.state_dict(), cur_path)
-                        logging.info(f"Save the current ID model to {cur_path}")
+                        self.save_checkpoint(self.model_gen.module, self.id_optimizer, self.id_scheduler, cur_path, 'gen')
+                        logging.info(f"Queued saving the current ID model to {cur_path}")
 
                     if self.rank == 0:
                         train_epoch_loss = sum(losses)/len(losses)
@@ -568,8 +576,22 @@ class DistributedRunner(SingleRunner):
             
         else:
             raise NotImplementedError
+        if self.rank == 0:
+            for checkpoint_writer in self.checkpoint_writers.values():
+                checkpoint_writer.close()
         return True
 
+    def save_checkpoint(self, model, optimizer, scheduler, path, group):
+        """
+        Queue a checkpoint of model (with optimizer and scheduler state if --save_optimizer) on the
+        background writer; only the CPU snapshot happens on the training thread.
+        """
+        if self.args.save_optimizer > 0:
+            state = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict()}
+        else:
+            state = model.state_dict()
+        self.checkpoint_writers[group].save(state, path)
+
     
     def get_testloader(self, model_gen=None, tokenizer=None, regenerate=False, phase=0):
         self.testloaders = []
@@ -598,7 +620,7 @@ class DistributedRunner(SingleRunner):
     def test(self, phase, path=None):
         self.model.eval()
         if path:
-            self.model.module.load_state_dict(torch.load(path, map_location=self.device))
+            self.model.module.load_state_dict(utils.load_model_state(path, self.device))
         for loader in self.testloaders:
             if self.test_filtered > 0:
                 if self.test_filtered_batch > 0:
@@ -624,6 +646,8 @@ class DistributedRunner(SingleRunner):
                 )
             
             prefix_allowed_tokens = gt.prefix_allowed_tokens_fn(candidate_trie)
+            # CSR index of each user's positives, built once instead of set lookups per prediction
+            positive_index = evaluate.PositiveIndex(testloader.dataset.positive, testloader.dataset.id2user)
             
             metrics_res = np.array([0.0] * len(self.metrics))
             for batch in tqdm(testloader):
@@ -655,7 +679,7 @@ class DistributedRunner(SingleRunner):
                     prediction_ids, skip_special_tokens=True
                 )
                 
-                rel_results = evaluate.rel_results_filtered(testloader.dataset.positive, testloader.dataset.id2user, user_idx.detach().cpu().numpy(), \
+                rel_results = evaluate.rel_results_filtered(positive_index, testloader.dataset.id2user, user_idx.detach().cpu().numpy(), \
                                                             self.generate_num+testloader.dataset.max_positive, \
                                                             generated_sents, gold_sents, prediction_scores, self.generate_num)
                 
@@ -236,7 +236,7 @@ class SingleRunner:
     def test(self, path=None):
         self.model.eval()
         if path:
-            self.model.load_state_dict(torch.load(path, map_location=self.device))
+            self.model.load_state_dict(utils.load_model_state(path, self.device))
         for loader in self.testloaders:
             if self.test_filtered > 0:
                 if self.test_filtered_batch > 0:
@@ -260,6 +260,8 @@ class SingleRunner:
                 ]
             )
             prefix_allowed_tokens = gt.prefix_allowed_tokens_fn(candidate_trie)
+            # CSR index of each user's positives, built once instead of set lookups per prediction
+            positive_index = evaluate.PositiveIndex(testloader.dataset.positive, testloader.dataset.id2user)
             
             metrics_res = np.array([0.0] * len(self.metrics))
             for batch in tqdm(testloader):
@@ -292,7 +294,7 @@ class SingleRunner:
                     prediction_ids, skip_special_tokens=True
                 )
                 
-                rel_results = evaluate.rel_results_filtered(testloader.dataset.positive, testloader.dataset.id2user, user_idx, \
+                rel_results = evaluate.rel_results_filtered(positive_index, testloader.dataset.id2user, user_idx, \
                                                             self.generate_num+testloader.dataset.max_positive, \
                                                             generated_sents, gold_sents, prediction_scores, self.generate_num)
                 
@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def snapshot_to_cpu(state):
+    """Copy of a (nested) state dict with every tensor moved to host memory."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(value) for value in state)
+    return state
+
+
+def save_atomic(state, path):
+    """torch.save to a temporary file and rename it, so path never holds a partially written checkpoint."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread.
+
+    The training thread only snapshots the state to CPU; torch.save and the atomic rename run on the writer
+    thread. At most one write is in flight (the next one waits for it), so at most one snapshot is held in
+    host memory. Write errors are raised from wait().
+
+    Checkpoints written with save are rotated: the last keep_last of them (None keeps all) are kept, plus the
+    one saved with is_best=True if it is older. submit writes a file outside the rotation.
+    """
+
+    def __init__(self, keep_last=None):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError(f'keep_last must be None or at least 1, got {keep_last}')
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint_writer')
+        self.pending = None
+        self.paths = []
+        self.best_path = None
+
+    def submit(self, state, path, remove_paths=()):
+        """Snapshot state to CPU and write it to path in the background, then remove remove_paths."""
+        self.wait()
+        snapshot = snapshot_to_cpu(state)
+        self.pending = self.executor.submit(self._write, snapshot, path, list(remove_paths))
+
+    def save(self, state, path, is_best=False):
+        """Like submit, but path takes part in the rotation of the last keep_last checkpoints."""
+        self.paths.append(path)
+        if is_best:
+            self.best_path = path
+
+        remove_paths = []
+        if self.keep_last is not None:
+            kept = set(self.paths[max(len(self.paths) - self.keep_last, 0):]) | {self.best_path}
+            remove_paths = [p for p in self.paths if p not in kept]
+            self.paths = [p for p in self.paths if p not in remove_paths]
+        self.submit(state, path, remove_paths)
+        return path
+
+    def wait(self):
+        """Wait for the write in flight."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    @staticmethod
+    def _write(state, path, remove_paths):
+        save_atomic(state, path)
+        for old_path in remove_paths:
+            if os.path.exists(old_path):
+                os.remove(old_path)
@@ -6,34 +6,78 @@ import random
 #DATASET = 'Kion'
 #DATASET = 'ML_20M'
 
+class PositiveIndex:
+    """
+    CSR index (indptr/indices) of every user's positive items, built once per test set.
+    Rows follow id2user order, so a batch is looked up by user_idx directly; item strings are
+    interned to integer ids and membership of a whole batch of predictions is one searchsorted.
+    """
+    def __init__(self, user_positive, id2user):
+        self.item2id = dict()
+        indptr = [0]
+        indices = []
+        for uidx in range(len(id2user)):
+            item_ids = {self.item2id.setdefault(item, len(self.item2id)) for item in user_positive[id2user[uidx]]}
+            indices.extend(sorted(item_ids))
+            indptr.append(len(indices))
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.num_items = max(len(self.item2id), 1)
+        # (row, item) keys are sorted because rows are consecutive and indices are sorted within a row
+        rows = np.repeat(np.arange(len(id2user), dtype=np.int64), np.diff(self.indptr))
+        self.keys = rows * self.num_items + self.indices
+
+    def seen_mask(self, user_idx, predictions, return_num):
+        """[batch_size, return_num] bool mask of predictions already in the user's positives."""
+        rows = np.repeat(np.asarray(user_idx, dtype=np.int64).reshape(-1), return_num)
+        item_ids = np.fromiter((self.item2id.get(pred, -1) for pred in predictions), dtype=np.int64,
+                               count=len(predictions))
+        keys = rows * self.num_items + item_ids
+        if len(self.keys) == 0:
+            return np.zeros((len(keys) // return_num, return_num), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        seen = (self.keys[pos] == keys) & (item_ids >= 0)
+        return seen.reshape(-1, return_num)
+
+
 def rel_results_filtered(user_positive, id2user, user_idx, return_num, predictions, targets, scores, k):
+    """
+    user_positive is either the {user: set of positives} dict (looked up per prediction) or a
+    PositiveIndex built from it once per test set (one vectorized lookup per batch; id2user is unused).
+    """
     results = []
     batch_length = len(targets)
+    if hasattr(user_idx, 'detach'):
+        user_idx = user_idx.detach().cpu().numpy()
+    if hasattr(scores, 'detach'):
+        scores = scores.detach().cpu().numpy()
+    scores = np.asarray(scores).reshape(batch_length, return_num)
+
+    if isinstance(user_positive, PositiveIndex):
+        seen = user_positive.seen_mask(user_idx, predictions, return_num)
+    else:
+        seen = np.zeros((batch_length, return_num), dtype=bool)
+        for b in range(batch_length):
+            positive = user_positive[id2user[user_idx[b]]]
+            seen[b] = [pred in positive for pred in predictions[b * return_num : (b + 1) * return_num]]
+
     for b in range(batch_length):
-        uidx = user_idx[b]
-        user_id = id2user[uidx]
-        positive = user_positive[user_id]
         one_batch_sequence = predictions[
             b * return_num : (b + 1) * return_num
         ]
-        one_batch_score = scores[
-            b * return_num : (b + 1) * return_num
-        ]
-        pairs = [(a, b) for a, b in zip(one_batch_sequence, one_batch_score)]
-        sorted_pairs = sorted(pairs, key=lambda x: x[1], reverse=True)
+        # stable sort keeps the beam order for equal scores, as sorted() did
+        order = np.argsort(-scores[b], kind='stable')
         gt = targets[b]
         one_results = []
-        for sorted_pred in sorted_pairs:
-            if sorted_pred[0] not in positive:
-                if sorted_pred[0] == gt:
+        for j in order:
+            if not seen[b, j]:
+                if one_batch_sequence[j] == gt:
                     one_results.append(1)
                 else:
                     one_results.append(0)
                 if len(one_results) >= k:
                     break
-            else:
-                continue
-        
+
         results.append(one_results)
     return results
 
@@ -38,6 +38,8 @@ def parse_global_args(parser):
     parser.add_argument("--test_epoch_id", type=int, default=1)
     parser.add_argument("--test_epoch_rec", type=int, default=5)
     parser.add_argument("--rounds", type=int, default=3, help="number of iterations")
+    parser.add_argument("--keep_last_checkpoints", type=int, default=0, help="keep only the last N checkpoints of each model, 0 keeps all")
+    parser.add_argument("--save_optimizer", type=int, default=0, help="also save optimizer and scheduler state in checkpoints")
     return parser
 
 def set_seed(seed):
@@ -137,10 +139,16 @@ def save_model(model, path):
     torch.save(model.state_dict(), path)
     return
     
+def load_model_state(path, loc=None):
+    state_dict = torch.load(path, map_location=loc)
+    # checkpoints saved with --save_optimizer hold the model weights under 'model'
+    if 'model' in state_dict and 'optimizer' in state_dict:
+        state_dict = state_dict['model']
+    return state_dict
+
 def load_model(model, path, args, loc=None):
     if loc is None and hasattr(args, 'gpu'):
         gpuid = args.gpu.split(',')
         loc = f'cuda:{gpuid[0]}'
-    state_dict = torch.load(path, map_location=loc)
-    model.load_state_dict(state_dict, strict=False)
+    model.load_state_dict(load_model_state(path, loc), strict=False)
     return model
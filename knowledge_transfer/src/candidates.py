@@ -0,0 +1,66 @@
+# src/candidates.py
+
+import numpy as np
+
+
+NEGATIVE_SAMPLING_SCHEMES = ['uniform', 'popularity']
+
+
+def sample_negative_candidates(sequences, num_users, num_items, num_negatives, sampling='uniform',
+                               item_counts=None, seed=42):
+    """
+    Негативы для протокола оценки "1 позитив + N негативов".
+
+    Для каждого пользователя сэмплируется num_negatives различных товаров, которых нет в его
+    последовательности (ни в истории, ни среди цели); 'uniform' - равномерно по каталогу, 'popularity' -
+    пропорционально item_counts. Если подходящих товаров меньше num_negatives, допускаются повторы.
+
+    Args:
+        sequences: Словарь {user_id: [items]} оцениваемой выборки (последний товар - цель)
+        num_users: Число пользователей (строк результата не меньше max(user_id) + 1)
+        num_items: Число товаров, id товаров - 1..num_items
+        item_counts: Частоты товаров [num_items + 1] для 'popularity'
+        seed: Зерно генератора; при одинаковых входах негативы совпадают между запусками
+
+    Returns:
+        np.ndarray [num_users, num_negatives] int64 - строки индексируются user_id.
+    """
+    if sampling not in NEGATIVE_SAMPLING_SCHEMES:
+        raise ValueError(f'Unknown negative sampling scheme: {sampling}')
+
+    rng = np.random.default_rng(seed)
+    items = np.arange(1, num_items + 1)
+    probs = None
+    if sampling == 'popularity':
+        probs = np.asarray(item_counts[1:num_items + 1], dtype=np.float64)
+        probs = probs / probs.sum()
+    sampleable = np.ones(num_items + 1, dtype=bool)
+    sampleable[0] = False
+    if probs is not None:
+        sampleable[1:] = probs > 0
+    num_sampleable = sampleable.sum()
+
+    num_users = max([num_users] + [user_id + 1 for user_id in sequences])
+    negatives = np.zeros((num_users, num_negatives), dtype=np.int64)
+    for user_id in sorted(sequences):
+        excluded = np.unique(np.asarray(sequences[user_id], dtype=np.int64))
+        excluded = excluded[(excluded >= 1) & (excluded <= num_items)]
+        # Число товаров, которые вообще могут выпасть (ненулевая вероятность) и не исключены
+        available = num_sampleable - sampleable[excluded].sum()
+        if available < num_negatives:
+            # Каталог меньше N + история: берём с повторами из всех доступных товаров
+            allowed = np.setdiff1d(items[sampleable[items]], excluded, assume_unique=True)
+            allowed_probs = None if probs is None else probs[allowed - 1] / probs[allowed - 1].sum()
+            negatives[user_id] = rng.choice(allowed, num_negatives, replace=True, p=allowed_probs)
+            continue
+
+        # Сэмплирование с отбраковкой: история обычно много меньше каталога
+        sampled = np.empty(0, dtype=np.int64)
+        while len(sampled) < num_negatives:
+            draws = rng.choice(items, 2 * num_negatives, p=probs)
+            draws = draws[~np.isin(draws, excluded)]
+            # Уникальные в порядке появления
+            _, first = np.unique(np.concatenate([sampled, draws]), return_index=True)
+            sampled = np.concatenate([sampled, draws])[np.sort(first)]
+        negatives[user_id] = sampled[:num_negatives]
+    return negatives
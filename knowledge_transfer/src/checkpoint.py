@@ -0,0 +1,109 @@
+# src/checkpoint.py
+
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def snapshot_to_cpu(state):
+    """Копия state (state_dict модели/оптимизатора, вложенные dict/list) с тензорами на хосте."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(value) for value in state)
+    return state
+
+
+def save_atomic(state, path):
+    """torch.save через временный файл и os.replace: по пути path никогда не лежит недописанный файл."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_rng_state(generators=()):
+    """Состояния генераторов random, numpy, torch (и CUDA) плюс переданных torch.Generator - для точного resume."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'generators': [generator.get_state() for generator in generators],
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state, generators=()):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    for generator, generator_state in zip(generators, state['generators']):
+        generator.set_state(generator_state)
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncCheckpointWriter:
+    """
+    Запись чекпоинтов в фоновом потоке.
+
+    На потоке обучения выполняется только снимок state на хост (snapshot_to_cpu); torch.save и os.replace
+    идут в отдельном потоке. В очереди не больше одной записи: следующая запись ждёт предыдущую, поэтому
+    в памяти хоста одновременно не больше одного снимка. Ошибки записи пробрасываются из wait().
+
+    Чекпоинты, записанные через save, ротируются: хранятся последние keep_last (None - все) и чекпоинт
+    с is_best=True, если он старше. submit пишет файл без ротации (лучшее состояние, итоговая модель).
+    """
+
+    def __init__(self, keep_last=None):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError(f'keep_last must be None or at least 1, got {keep_last}')
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint_writer')
+        self.pending = None
+        self.paths = []
+        self.best_path = None
+
+    def submit(self, state, path, remove_paths=()):
+        """Снимает state на хост и записывает его в path в фоне; после записи удаляет remove_paths."""
+        self.wait()
+        snapshot = snapshot_to_cpu(state)
+        self.pending = self.executor.submit(self._write, snapshot, path, list(remove_paths))
+
+    def save(self, state, path, is_best=False):
+        """Как submit, но path входит в ротацию последних keep_last чекпоинтов."""
+        self.paths.append(path)
+        if is_best:
+            self.best_path = path
+
+        remove_paths = []
+        if self.keep_last is not None:
+            kept = set(self.paths[max(len(self.paths) - self.keep_last, 0):]) | {self.best_path}
+            remove_paths = [p for p in self.paths if p not in kept]
+            self.paths = [p for p in self.paths if p not in remove_paths]
+        self.submit(state, path, remove_paths)
+        return path
+
+    def wait(self):
+        """Дожидается текущей записи."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    @staticmethod
+    def _write(state, path, remove_paths):
+        save_atomic(state, path)
+        for old_path in remove_paths:
+            if os.path.exists(old_path):
+                os.remove(old_path)
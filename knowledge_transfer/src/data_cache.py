@@ -0,0 +1,186 @@
+# src/data_cache.py
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+import torch
+
+from src.utils import load_user_profile_embeddings_any, get_embeddings_ids_path
+
+
+def get_cache_dir(config):
+    """
+    Каталог кэша предобработанных данных: config['data']['cache_dir'] (или прежний padded_cache_dir),
+    None - кэш выключен.
+    """
+    return config['data'].get('cache_dir', config['data'].get('padded_cache_dir'))
+
+
+def get_cache_path(cache_dir, name, source_paths, **params):
+    """
+    Путь к .npy в кэше. Ключ - абсолютные пути и mtime исходных файлов плюс params, поэтому после
+    изменения любого исходного файла старая запись просто перестаёт использоваться.
+    """
+    key_parts = []
+    for path in source_paths:
+        path = os.path.abspath(path)
+        key_parts.append(f'{path}:{int(os.path.getmtime(path))}')
+    key_parts.extend(f'{param}={value}' for param, value in sorted(params.items()))
+    key_hash = hashlib.md5('|'.join(key_parts).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{name}_{key_hash}.npy')
+
+
+def save_npy_atomic(path, array):
+    """Сохраняет массив через временный файл: параллельные запуски не увидят недописанный кэш."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def load_npy_shared(path):
+    """
+    Открывает кэш через memory-map в режиме copy-on-write: страницы файла общие для всех процессов
+    перебора (через page cache), а запись в массив не трогает файл.
+    """
+    return np.load(path, mmap_mode='c')
+
+
+def get_padded_cache_path(config, data_key):
+    """
+    Путь к .npy-кэшу паддингованных последовательностей для config['data'][data_key]
+    или None, если кэш выключен.
+    Ключ включает путь и mtime исходного файла и maxlen; раскладка одинакова для всех моделей.
+    """
+    cache_dir = get_cache_dir(config)
+    if cache_dir is None:
+        return None
+    sequences_path = config['data'][data_key]
+    stem = os.path.splitext(os.path.basename(sequences_path))[0]
+    return get_cache_path(cache_dir, f'padded_{stem}', [sequences_path], maxlen=config['model']['maxlen'])
+
+
+def load_sequences(config, data_key):
+    """
+    Словарь последовательностей {user_id: [items]} из config['data'][data_key] или None, если
+    паддингованный кэш уже есть - тогда датасет читает его через memory-map и pickle не нужен.
+    """
+    cache_path = get_padded_cache_path(config, data_key)
+    if cache_path is not None and os.path.exists(cache_path):
+        return None
+    with open(config['data'][data_key], 'rb') as f:
+        return pickle.load(f)
+
+
+def load_item_counts(config, data_key, item_num, sequences=None):
+    """Частоты товаров по config['data'][data_key] ([item_num + 1]); кэшируются, если кэш включён."""
+    from src.losses import compute_item_counts
+
+    cache_dir = get_cache_dir(config)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_cache_path(cache_dir, 'item_counts', [config['data'][data_key]], item_num=item_num)
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+    if sequences is None:
+        with open(config['data'][data_key], 'rb') as f:
+            sequences = pickle.load(f)
+    item_counts = compute_item_counts(sequences, item_num)
+    if cache_path is not None:
+        save_npy_atomic(cache_path, item_counts)
+    return item_counts
+
+
+def load_history_index(config, data_key, num_users):
+    """
+    CSR-индекс истории пользователей (indptr, indices) по config['data'][data_key] без последнего
+    товара каждой последовательности (см. build_history_csr); кэшируется, если кэш включён.
+    """
+    from src.history_index import build_history_csr
+
+    cache_dir = get_cache_dir(config)
+    if cache_dir is not None:
+        source_paths = [config['data'][data_key]]
+        indptr_path = get_cache_path(cache_dir, 'history_indptr', source_paths, num_users=num_users)
+        indices_path = get_cache_path(cache_dir, 'history_indices', source_paths, num_users=num_users)
+        if os.path.exists(indptr_path) and os.path.exists(indices_path):
+            return load_npy_shared(indptr_path), load_npy_shared(indices_path)
+
+    with open(config['data'][data_key], 'rb') as f:
+        sequences = pickle.load(f)
+    indptr, indices = build_history_csr(sequences, num_users)
+    if cache_dir is not None:
+        save_npy_atomic(indptr_path, indptr)
+        save_npy_atomic(indices_path, indices)
+    return indptr, indices
+
+
+def load_negative_candidates(config, data_key, num_users, num_items, num_negatives, sampling='uniform', seed=42):
+    """
+    Негативы протокола "1 позитив + N негативов" для config['data'][data_key] [num_users, num_negatives]
+    (см. sample_negative_candidates). С включённым кэшем сэмплируются один раз на выборку и параметры
+    и в следующих запусках читаются с диска.
+    """
+    from src.candidates import sample_negative_candidates
+
+    cache_dir = get_cache_dir(config)
+    source_paths = [config['data'][data_key]]
+    if sampling == 'popularity':
+        source_paths.append(config['data']['profile_train_sequences'])
+    if cache_dir is not None:
+        cache_path = get_cache_path(cache_dir, 'negatives', source_paths, num_users=num_users, num_items=num_items,
+                                    num_negatives=num_negatives, sampling=sampling, seed=seed)
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+    item_counts = None
+    if sampling == 'popularity':
+        item_counts = load_item_counts(config, 'profile_train_sequences', num_items)
+    with open(config['data'][data_key], 'rb') as f:
+        sequences = pickle.load(f)
+    negatives = sample_negative_candidates(sequences, num_users, num_items, num_negatives, sampling=sampling,
+                                           item_counts=item_counts, seed=seed)
+    if cache_dir is not None:
+        save_npy_atomic(cache_path, negatives)
+    return negatives
+
+
+def load_profile_table(config):
+    """
+    Таблица эмбеддингов профилей [num_users, (K,) emb_dim] и маска отсутствующих профилей [num_users]
+    (см. load_user_profile_embeddings_any).
+
+    С включённым кэшем обе записи сохраняются как .npy (ключ - файлы эмбеддингов и маппингов, их mtime
+    и multi_profile; для бинарных эмбеддингов и <name>.ids.json) и в следующих запусках открываются через
+    memory-map без чтения JSON и маппингов.
+    """
+    cache_dir = get_cache_dir(config)
+    if cache_dir is None:
+        return load_user_profile_embeddings_any(config, _load_user_id_mapping(config))
+
+    files_list = config['data']['user_profile_embeddings_files']
+    if isinstance(files_list, str):
+        files_list = [files_list]
+    source_paths = list(files_list) + [config['data']['mappings']]
+    # Порядок строк бинарного файла задаёт <name>.ids.json, его можно перегенерировать отдельно от .npy
+    source_paths += [get_embeddings_ids_path(path) for path in files_list if path.endswith('.npy')]
+    multi_profile = config['model'].get('multi_profile', False)
+    table_path = get_cache_path(cache_dir, 'profiles', source_paths, multi_profile=multi_profile)
+    mask_path = get_cache_path(cache_dir, 'profiles_mask', source_paths, multi_profile=multi_profile)
+
+    if not (os.path.exists(table_path) and os.path.exists(mask_path)):
+        table, mask = load_user_profile_embeddings_any(config, _load_user_id_mapping(config))
+        save_npy_atomic(table_path, table.numpy())
+        save_npy_atomic(mask_path, mask.numpy())
+        return table, mask
+
+    return torch.from_numpy(load_npy_shared(table_path)), torch.from_numpy(load_npy_shared(mask_path))
+
+
+def _load_user_id_mapping(config):
+    with open(config['data']['mappings'], 'rb') as f:
+        user_id_mapping, item_id_mapping = pickle.load(f)
+    return user_id_mapping
@@ -1,20 +1,148 @@
 # src/dataset.py
 
+import os
 import torch
 import random
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+from src.data_cache import save_npy_atomic
+
+
+def pad_sequences(sequences, maxlen, cache_path=None):
+    """
+    Превращает словарь последовательностей в один непрерывный массив с паддингом слева.
+
+    Args:
+        sequences: Словарь {user_id: [item1, item2, ...]} (может быть None, если кэш уже есть)
+        maxlen: Длина строки (берутся последние maxlen товаров)
+        cache_path: Путь к .npy-кэшу. Если файл есть, он открывается через memory-map,
+            иначе массив строится и сохраняется туда.
+
+    Returns:
+        np.ndarray [num_users, maxlen + 1] int32: столбец 0 - user_id, остальные - товары.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        return np.load(cache_path, mmap_mode='r')
+
+    padded = np.zeros((len(sequences), maxlen + 1), dtype=np.int32)
+    for row, (user_id, seq) in enumerate(sequences.items()):
+        seq = seq[-maxlen:]
+        padded[row, 0] = user_id
+        if len(seq) > 0:
+            padded[row, maxlen + 1 - len(seq):] = seq
+
+    if cache_path is not None:
+        save_npy_atomic(cache_path, padded)
+    return padded
+
+
+def mask_sequences(seqs, mask_token, mask_prob, generator=None):
+    """
+    Vectorized BERT4Rec masking for a batch of padded sequences.
+
+    Args:
+        seqs: LongTensor [batch_size, maxlen] (0 = padding)
+        mask_token: Token ID used for masking
+        mask_prob: Probability of masking a token
+        generator: Optional torch.Generator for reproducible masks
+
+    Returns:
+        input_seq with masked positions replaced by mask_token and target_seq holding
+        the original items at masked non-padding positions and -100 elsewhere.
+    """
+    masked = torch.rand(seqs.shape, generator=generator, device=seqs.device) < mask_prob
+    input_seq = seqs.masked_fill(masked, mask_token)
+    target_seq = seqs.masked_fill(~masked | (seqs == 0), -100)
+    return input_seq, target_seq
+
+
+def collate_pretensorized(batch):
+    """
+    collate_fn для датасетов с `__getitems__`: батч уже собран одним fancy-index, поэтому
+    возвращается как есть.
+    """
+    return batch
+
+
+def collate_trimmed(batch):
+    """
+    collate_fn для SequenceDataset при батчинге по длине: обрезает слева паддинг, общий для всего батча.
+
+    Окно - самая длинная цель в батче (на одну позицию длиннее входа), поэтому в лосс попадают те же
+    позиции, что и без обрезки.
+    """
+    input_seq, target_seq, user_ids = batch
+    trimmed_len = max(int((target_seq != 0).sum(dim=1).max()), 1)
+    return input_seq[:, -trimmed_len:].contiguous(), target_seq[:, -trimmed_len:].contiguous(), user_ids
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Батч-сэмплер, группирующий пользователей с близкой длиной последовательности.
+
+    При shuffle индексы перемешиваются, режутся на корзины по bucket_batches батчей, внутри корзины
+    сортируются по длине и делятся на батчи; порядок батчей тоже перемешивается. Без shuffle - батчи
+    по глобальной сортировке длин. Вместе с collate_trimmed короткие истории идут короткими тензорами.
+
+    num_replicas/rank - для распределённого обучения: все процессы строят одинаковые батчи (один сид),
+    процесс берёт каждый num_replicas-й. При shuffle список дополняется повтором первых батчей, чтобы
+    у всех процессов было одинаковое число шагов; без shuffle (оценка) батчи не повторяются.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, generator=None, bucket_batches=50,
+                 num_replicas=1, rank=0):
+        self.lengths = torch.as_tensor(np.asarray(lengths), dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.bucket_batches = bucket_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        if self.shuffle:
+            return (num_batches + self.num_replicas - 1) // self.num_replicas
+        return len(range(self.rank, num_batches, self.num_replicas))
+
+    def __iter__(self):
+        if not self.shuffle:
+            order = torch.argsort(self.lengths, stable=True)
+            batches = [order[start:start + self.batch_size].tolist()
+                       for start in range(0, len(order), self.batch_size)]
+            yield from batches[self.rank::self.num_replicas]
+            return
+
+        permutation = torch.randperm(len(self.lengths), generator=self.generator)
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(permutation), bucket_size):
+            bucket = permutation[start:start + bucket_size]
+            bucket = bucket[torch.argsort(self.lengths[bucket], stable=True)]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        batch_order = torch.randperm(len(batches), generator=self.generator).tolist()
+        total = len(self) * self.num_replicas
+        batch_order = (batch_order * (total // len(batch_order) + 1))[:total][self.rank::self.num_replicas]
+        for batch_idx in batch_order:
+            yield batches[batch_idx].tolist()
 
 
 class SequenceDataset(Dataset):
-    def __init__(self, sequences, maxlen):
-        self.sequences = sequences
+    def __init__(self, sequences, maxlen, cache_path=None):
         self.maxlen = maxlen
-        self.user_ids = list(sequences.keys())
+        # [num_users, maxlen + 1]: user_id и последние maxlen товаров с паддингом нулями спереди
+        self.padded = pad_sequences(sequences, maxlen, cache_path)
+        self.user_ids = self.padded[:, 0]
 
     def __len__(self):
         return len(self.user_ids)
 
+    def sequence_lengths(self):
+        """Число товаров в каждой строке (без паддинга) [num_users] - для LengthBucketBatchSampler."""
+        return (self.padded[:, 1:] != 0).sum(axis=1)
+
     # def __getitem__(self, idx):
     #     user_id = self.user_ids[idx]
     #     seq = self.sequences[user_id]
@@ -29,28 +157,22 @@ class SequenceDataset(Dataset):
     #     return input_seq, target, torch.tensor(user_id, dtype=torch.long)
 
     def __getitem__(self, idx):
-        user_id = self.user_ids[idx]
-        seq = self.sequences[user_id]
-
-        # Обрезаем или дополняем последовательность до maxlen
-        seq = seq[-self.maxlen:]
-        seq = [0] * (self.maxlen - len(seq)) + seq  # Дополняем нулями спереди
+        row = torch.from_numpy(self.padded[idx].astype(np.int64))
+        seq = row[1:]
 
-        input_seq = torch.tensor(seq[:-1], dtype=torch.long)
-        target = torch.tensor(seq[1:], dtype=torch.long)
+        return seq[:-1].contiguous(), seq[1:].contiguous(), row[0]
 
-        # Проверка на NaN или Inf
-        if torch.isnan(input_seq).any() or torch.isinf(input_seq).any():
-            print(f"NaN or Inf detected in input_seq for user {user_id}")
-        if torch.isnan(target).any() or torch.isinf(target).any():
-            print(f"NaN or Inf detected in target for user {user_id}")
+    def __getitems__(self, indices):
+        """Батч целиком одним fancy-index (используется DataLoader вместе с collate_pretensorized)."""
+        rows = torch.from_numpy(self.padded[np.asarray(indices)].astype(np.int64))  # [batch_size, maxlen + 1]
+        seqs = rows[:, 1:]
 
-        return input_seq, target, torch.tensor(user_id, dtype=torch.long)
+        return seqs[:, :-1].contiguous(), seqs[:, 1:].contiguous(), rows[:, 0].contiguous()
 
 
 class BERT4RecDataset(Dataset):
     def __init__(self, sequences, maxlen, mask_token, num_items,
-                 mask_prob=0.15, mode='train', seed=42):
+                 mask_prob=0.15, mode='train', seed=42, cache_path=None):
         """
         Dataset for BERT4Rec model.
 
@@ -62,66 +184,80 @@ class BERT4RecDataset(Dataset):
             mask_prob: Probability of masking a token during training
             mode: 'train', 'valid', or 'test'
             seed: Random seed for reproducibility
+            cache_path: Optional .npy cache of the padded sequences (memory-mapped if it exists)
         """
-        self.sequences = sequences
         self.maxlen = maxlen
         self.mask_token = mask_token
         self.num_items = num_items
         self.mask_prob = mask_prob
         self.mode = mode
-        self.user_ids = list(sequences.keys())
+        # [num_users, maxlen + 1]: user_id followed by the left-padded last maxlen items
+        self.padded = pad_sequences(sequences, maxlen, cache_path)
+        self.user_ids = self.padded[:, 0]
 
         # Set random seed for reproducibility
         random.seed(seed)
         np.random.seed(seed)
+        self.seed = seed
+        # Shared memory, so that set_epoch also reaches (persistent) DataLoader workers
+        self.epoch = torch.zeros(1, dtype=torch.long).share_memory_()
 
     def __len__(self):
         return len(self.user_ids)
 
-    def __getitem__(self, idx):
-        user_id = self.user_ids[idx]
-        seq = self.sequences[user_id]
+    def set_epoch(self, epoch):
+        """Changes the training masks between epochs; call before iterating over the loader."""
+        self.epoch.fill_(epoch)
 
-        # Trim sequence to maxlen
-        if len(seq) > self.maxlen:
-            # Keep the most recent items
-            seq = seq[-self.maxlen:]
+    def _batch_generator(self, indices):
+        """
+        Generator seeded by (seed, epoch, first index of the batch): masks do not depend
+        on which DataLoader worker builds the batch.
+        """
+        state = np.random.SeedSequence([self.seed, int(self.epoch.item()), int(indices[0])]).generate_state(1)[0]
+        return torch.Generator().manual_seed(int(state))
+
+    def _build_train_batch(self, indices):
+        """Vectorized train inputs (random masking) for a list of dataset indices."""
+        rows = torch.from_numpy(self.padded[np.asarray(indices)].astype(np.int64))
+        seqs = rows[:, 1:]
+
+        # Attention mask (1 for real items, 0 for padding)
+        attention_mask = (seqs != 0).long()
+        # Randomly mask items; targets are -100 (ignored in loss) for unmasked items and padding
+        input_seq, target_seq = mask_sequences(seqs, self.mask_token, self.mask_prob,
+                                               generator=self._batch_generator(indices))
+
+        return input_seq, target_seq, attention_mask, rows[:, 0].contiguous()
+
+    def _build_inference_batch(self, rows):
+        """Vectorized valid/test inputs for rows [batch_size, maxlen + 1]."""
+        seqs = rows[:, 1:]
 
-        # Create attention mask (1 for real items, 0 for padding)
-        attention_mask = [0] * (self.maxlen - len(seq)) + [1] * len(seq)
+        # For inference, we append a mask token at the end to predict the next item
+        input_seq = seqs.clone()
+        input_seq[:, -1] = self.mask_token  # Replace last token with mask
+        target_seq = torch.full_like(seqs, -100)
+        target_seq[:, -1] = seqs[:, -1]  # Only predict the last item
+
+        # Attention mask (1 for real items, 0 for padding), the mask token is always attended
+        attention_mask = (seqs != 0).long()
+        attention_mask[:, -1] = 1
+
+        return input_seq, target_seq, attention_mask, rows[:, 0].contiguous()
+
+    def __getitem__(self, idx):
+        if self.mode != 'train':
+            input_seq, target_seq, attention_mask, user_id = self._build_inference_batch(
+                torch.from_numpy(self.padded[idx:idx + 1].astype(np.int64)))
+            return input_seq[0], target_seq[0], attention_mask[0], user_id[0]
 
-        # Pad sequence
-        seq = [0] * (self.maxlen - len(seq)) + seq
+        input_seq, target_seq, attention_mask, user_id = self._build_train_batch([idx])
+        return input_seq[0], target_seq[0], attention_mask[0], user_id[0]
 
+    def __getitems__(self, indices):
+        """Whole batch at once (used by DataLoader together with collate_pretensorized)."""
         if self.mode == 'train':
-            # Create inputs and targets
-            input_seq = seq.copy()
-            target_seq = seq.copy()
-
-            # Randomly mask items for training
-            for i in range(len(seq)):
-                if seq[i] == 0:  # Skip padding
-                    target_seq[i] = -100
-
-                if random.random() < self.mask_prob:
-                    input_seq[i] = self.mask_token  # Replace with mask token
-
-            # For items that are not masked, set target to -100 (ignore in loss)
-            for i in range(len(seq)):
-                if input_seq[i] != self.mask_token:
-                    target_seq[i] = -100
-
-        else:  # valid or test
-            # For inference, we append a mask token at the end to predict the next item
-            input_seq = seq[:-1] + [self.mask_token]  # Replace last token with mask
-            target_seq = [-100] * (len(seq) - 1) + [seq[-1]]  # Only predict the last item
-
-            # Update attention mask for the mask token
-            attention_mask = attention_mask[:-1] + [1]
-
-        return (
-            torch.tensor(input_seq, dtype=torch.long),
-            torch.tensor(target_seq, dtype=torch.long),
-            torch.tensor(attention_mask, dtype=torch.long),
-            torch.tensor(user_id, dtype=torch.long)
-        )
\ No newline at end of file
+            return self._build_train_batch(indices)
+        rows = torch.from_numpy(self.padded[np.asarray(indices)].astype(np.int64))
+        return self._build_inference_batch(rows)
@@ -0,0 +1,84 @@
+# src/distributed.py
+
+import os
+import datetime
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    """True внутри процесса, запущенного launch_distributed (группа процессов инициализирована)."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def all_reduce_sum(tensor):
+    """Суммирует тензор по всем процессам на месте (без распределённого режима - ничего не делает)."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def broadcast_parameters(model):
+    """Копирует параметры и буферы процесса 0 во все процессы."""
+    if is_distributed():
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src=0)
+
+
+def sync_gradients(model):
+    """
+    Усредняет градиенты по процессам одним all_reduce по плоскому буферу.
+
+    Используется вместо обёртки DistributedDataParallel: параметры агрегации профиля участвуют в guide-лоссе
+    вне forward и не получают градиентов после fine_tune_epoch, что редуктор DDP не поддерживает.
+    Параметры без градиента на этом шаге не редуцируются и остаются с grad=None (оптимизатор их пропускает,
+    как и в одном процессе); набор таких параметров одинаков во всех процессах (общий guide_active).
+    """
+    if not is_distributed():
+        return
+    params = [param for param in model.parameters() if param.requires_grad and param.grad is not None]
+    if not params:
+        return
+    flat = torch.cat([param.grad.reshape(-1) for param in params])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for param in params:
+        numel = param.numel()
+        param.grad = flat[offset:offset + numel].view_as(param).clone()
+        offset += numel
+
+
+def launch_distributed(config, train_fn):
+    """
+    Запускает train_fn(config, rank=..., world_size=...) в config['distributed']['world_size'] процессах.
+
+    Секция config['distributed']: world_size, backend ('gloo' по умолчанию - обучение на CPU; 'nccl' - по
+    GPU на процесс), master_addr, master_port, threads_per_process (по умолчанию ядра делятся поровну).
+    """
+    dist_config = config['distributed']
+    mp.spawn(_distributed_worker, args=(config, train_fn), nprocs=dist_config['world_size'], join=True)
+
+
+def _distributed_worker(rank, config, train_fn):
+    dist_config = config['distributed']
+    world_size = dist_config['world_size']
+    os.environ['MASTER_ADDR'] = str(dist_config.get('master_addr', '127.0.0.1'))
+    os.environ['MASTER_PORT'] = str(dist_config.get('master_port', 29500))
+
+    # Без ограничения каждый процесс займёт все ядра, и они будут мешать друг другу
+    threads = dist_config.get('threads_per_process', max(1, (os.cpu_count() or 1) // world_size))
+    torch.set_num_threads(threads)
+
+    dist.init_process_group(
+        backend=dist_config.get('backend', 'gloo'), timeout=datetime.timedelta(seconds=18000),
+        world_size=world_size, rank=rank
+    )
+    try:
+        train_fn(config, rank=rank, world_size=world_size)
+        dist.barrier()
+    finally:
+        dist.destroy_process_group()
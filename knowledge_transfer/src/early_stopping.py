@@ -0,0 +1,95 @@
+# src/early_stopping.py
+
+import os
+
+import torch
+
+
+BEST_STATE_STORAGES = ['memory', 'disk']
+
+
+class EarlyStopping:
+    """
+    Отслеживает валидационную метрику, хранит состояние модели с лучшим значением и решает,
+    когда останавливать обучение.
+
+    Метрики с префиксом 'loss' минимизируются, остальные (NDCG@10, HitRate@20, ...) максимизируются.
+    Лучшее состояние хранится копией state_dict в памяти хоста ('memory') или файлом best_path ('disk');
+    с writer (AsyncCheckpointWriter) файл пишется в фоне.
+    patience - число оценок подряд без улучшения больше min_delta, после которого should_stop() = True;
+    None - обучение не останавливается, только выбирается лучшая эпоха.
+
+    При распределённом обучении метрики одинаковы во всех процессах, поэтому решение об остановке тоже
+    одинаково; состояние хранит только процесс 0 (save_state=False в остальных).
+    """
+
+    def __init__(self, metric, patience=None, min_delta=0.0, storage='memory', best_path=None, save_state=True,
+                 writer=None):
+        if storage not in BEST_STATE_STORAGES:
+            raise ValueError(f'Unknown best state storage: {storage}')
+        if storage == 'disk' and best_path is None:
+            raise ValueError("best_path is required for storage='disk'")
+
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.storage = storage
+        self.best_path = best_path
+        self.save_state = save_state
+        self.writer = writer
+        self.maximize = not metric.startswith('loss')
+
+        self.best_value = None
+        self.best_epoch = None
+        self.best_state = None
+        self.bad_evaluations = 0
+
+    def step(self, metrics, model, epoch):
+        """Учитывает метрики очередной валидации; при улучшении сохраняет состояние модели. Возвращает improved."""
+        if self.metric not in metrics:
+            raise ValueError(f'Early stopping metric {self.metric} is not in validation metrics: {list(metrics)}')
+        value = metrics[self.metric]
+
+        if self.best_value is None:
+            improved = True
+        elif self.maximize:
+            improved = value > self.best_value + self.min_delta
+        else:
+            improved = value < self.best_value - self.min_delta
+
+        if improved:
+            self.best_value = value
+            self.best_epoch = epoch
+            self.bad_evaluations = 0
+            if self.save_state:
+                self._save(model)
+        else:
+            self.bad_evaluations += 1
+        return improved
+
+    def should_stop(self):
+        return self.patience is not None and self.bad_evaluations >= self.patience
+
+    def restore(self, model):
+        """Загружает в модель лучшее сохранённое состояние (если валидаций не было - ничего не делает)."""
+        if self.best_epoch is None or not self.save_state:
+            return
+        if self.storage == 'disk':
+            if self.writer is not None:
+                self.writer.wait()
+            state = torch.load(self.best_path, map_location='cpu')
+        else:
+            state = self.best_state
+        model.load_state_dict(state)
+
+    def _save(self, model):
+        if self.storage == 'disk' and self.writer is not None:
+            self.writer.submit(model.state_dict(), self.best_path)
+            return
+        # Копия на хосте: дальнейшие шаги оптимизатора не должны менять сохранённые веса
+        state = {name: tensor.detach().to('cpu', copy=True) for name, tensor in model.state_dict().items()}
+        if self.storage == 'disk':
+            os.makedirs(os.path.dirname(self.best_path) or '.', exist_ok=True)
+            torch.save(state, self.best_path)
+        else:
+            self.best_state = state
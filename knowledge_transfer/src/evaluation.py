@@ -3,12 +3,16 @@
 import torch
 import numpy as np
 
-from src.utils import calculate_guide_loss, calculate_recsys_loss
+from src.losses import SampledRecsysLoss
+from src.distributed import all_reduce_sum
+from src.metrics import RankingMetrics, streaming_target_ranks, candidate_scores
+from src.utils import calculate_guide_loss, calculate_recsys_loss, get_autocast
 
 
 def evaluate_model(model, data_loader, device, mode='validation',
-                   model_criterion=None, criterion_reconstruct_fn=None, user_profile_embeddings=None,
-                   null_profile_binary_mask=None, k_list=[5, 10, 20]):
+                   model_criterion=None, criterion_reconstruct_fn=None, profile_store=None,
+                   k_list=[5, 10, 20], precision='fp32', non_blocking=False, item_chunk_size=None,
+                   seen_items=None, negative_candidates=None):
     """
     Оценивает модель на заданном наборе данных.
 
@@ -17,48 +21,88 @@ def evaluate_model(model, data_loader, device, mode='validation',
         data_loader (DataLoader): DataLoader для набора данных.
         device (torch.device): Устройство для вычислений.
         mode (str): Режим оценки - 'validation' или 'test'.
+        profile_store (ProfileEmbeddingStore): Эмбеддинги профилей для guide-лосса или None.
         k_list (list): Список значений k для метрик.
+        precision (str): Точность прямого прохода - 'fp32', 'bf16' или 'fp16'.
+        non_blocking (bool): Асинхронный перенос батчей на устройство (с pin_memory).
+        item_chunk_size (int): Если задан, каталог скорится блоками по item_chunk_size товаров
+            (streaming_target_ranks) вместо плотной матрицы [batch_size, num_items]; метрики те же.
+        seen_items (SeenItemIndex): Если задан, товары из истории пользователя не ранжируются (кроме цели).
+        negative_candidates (torch.Tensor): Негативы [num_users, N] на устройстве (см. load_negative_candidates).
+            Если заданы, цель ранжируется только среди своих N негативов (протокол "1 позитив + N негативов").
 
     Returns:
         dict: Словарь со средними значениями метрик для каждого k.
     """
     model.eval()
-    recalls = {k: 0 for k in k_list}
-    ndcgs = {k: 0 for k in k_list}
+    ranking_metrics = RankingMetrics(k_list, device=device)
+    # Лоссы копим на устройстве, чтобы не синхронизироваться с хостом на каждом батче
     losses = {'loss_recsys': [], 'loss_guide': []}
+    compute_losses = model_criterion is not None or criterion_reconstruct_fn is not None
+    # Сэмплированный лосс считается по скрытым состояниям, полному лоссу нужны логиты всех позиций
+    recsys_on_hidden = isinstance(model_criterion, SampledRecsysLoss)
+    # Параметры при оценке не меняются: проецируем профили всех пользователей один раз
+    # (или берём проекцию из кэша, если параметры агрегации не менялись с прошлого вызова)
+    if criterion_reconstruct_fn is not None and profile_store is not None and not profile_store.projected:
+        profile_store = profile_store.project(model)
 
     with torch.no_grad():
         # c = 0
         for batch in data_loader:
             input_seq, target_seq, user_ids = batch
-            input_seq = input_seq.to(device)
-            target_seq = target_seq.to(device)
+            input_seq = input_seq.to(device, non_blocking=non_blocking)
+            target_seq = target_seq.to(device, non_blocking=non_blocking)
             # Получаем эмбеддинги профиля пользователя, если они существуют
-            if user_profile_embeddings is not None:
-                user_profile_emb = user_profile_embeddings[user_ids].to(device)
-                null_profile_binary_mask_batch = null_profile_binary_mask[user_ids].to(device)
+            if profile_store is not None:
+                user_profile_emb, null_profile_binary_mask_batch = profile_store.gather(user_ids)
             else:
                 user_profile_emb = None
 
-            # Прямой проход
-            outputs = model(input_seq)
-            hidden_for_reconstruction = None
-
-            # Если модель возвращает кортеж, извлекаем первый элемент
-            if isinstance(outputs, tuple):
-                outputs, hidden_for_reconstruction = outputs
-
-            if model_criterion is not None:
-                loss_model = calculate_recsys_loss(target_seq, outputs, model_criterion)
-                losses['loss_recsys'].append(loss_model.item())
-            if criterion_reconstruct_fn is not None:
-                loss_guide = calculate_guide_loss(model, user_profile_emb, hidden_for_reconstruction,
-                                                  null_profile_binary_mask_batch, criterion_reconstruct_fn)
-                losses['loss_guide'].append(loss_guide.item())
-                # print(loss_guide.item())
-
-            # Получаем предсказания для последнего элемента в последовательности
-            logits = outputs[:, -1, :]  # [batch_size, item_num + 1]
+            # В пониженной точности работает только энкодер; скоринг каталога ниже идёт в fp32 вне autocast,
+            # иначе округление скоров даёт ничьи с целью
+            with get_autocast(device, precision):
+                if compute_losses:
+                    # Прямой проход по всем позициям: скрытые состояния для лоссов и метрик
+                    outputs = model(input_seq, apply_head=False)
+                    hidden_for_reconstruction = None
+
+                    # Если модель возвращает кортеж, извлекаем первый элемент
+                    if isinstance(outputs, tuple):
+                        outputs, hidden_for_reconstruction = outputs
+
+                    if model_criterion is not None:
+                        recsys_outputs = outputs if recsys_on_hidden else model.score_hidden(outputs)
+                        loss_model = calculate_recsys_loss(target_seq, recsys_outputs, model_criterion)
+                        losses['loss_recsys'].append(loss_model.detach())
+                    if criterion_reconstruct_fn is not None:
+                        loss_guide = calculate_guide_loss(model, user_profile_emb, hidden_for_reconstruction,
+                                                          null_profile_binary_mask_batch, criterion_reconstruct_fn,
+                                                          profile_projected=profile_store.projected)
+                        losses['loss_guide'].append(loss_guide.detach())
+                        # print(loss_guide.item())
+
+                    last_hidden = outputs[:, -1, :]  # [batch_size, hidden_units]
+                else:
+                    # Без лоссов нужна только последняя позиция, [batch_size, seq_len, item_num + 1] не материализуется
+                    last_hidden = model.predict_next(input_seq, apply_head=False)  # [batch_size, hidden_units]
+
+            if negative_candidates is not None:
+                # Цель в столбце 0, дальше N негативов пользователя: O(batch_size * N) вместо всего каталога
+                candidates = torch.cat([target_seq[:, -1:], negative_candidates[user_ids.to(device)]], dim=1)
+                scores = candidate_scores(last_hidden, *model.output_embeddings(), candidates)
+                ranking_metrics.update_from_logits(scores, torch.zeros_like(candidates[:, 0]))
+                continue
+
+            if item_chunk_size is not None:
+                weight, bias = model.output_embeddings()
+                ranks = streaming_target_ranks(last_hidden, weight, bias, target_seq[:, -1], item_chunk_size)
+                if seen_items is not None:
+                    ranks = seen_items.correct_ranks(ranks, last_hidden, weight, bias, user_ids, target_seq[:, -1])
+                ranking_metrics.update(ranks)
+                continue
+
+            # Метрики считаем в fp32 независимо от точности прямого прохода
+            logits = model.score_hidden(last_hidden.float())  # [batch_size, item_num + 1]
 
             if mode in ['test', 'validation']:
                 # В режиме тестирования рассматриваем только один позитивный элемент
@@ -71,88 +115,75 @@ def evaluate_model(model, data_loader, device, mode='validation',
                 targets = target_seq[:, -1]
                 logits[:, 0] = -np.inf
 
-            # Получаем топ-K предсказаний
-            _, indices = torch.topk(logits, max(k_list), dim=1)  # [batch_size, max(k_list)]
-
-            for k in k_list:
-                preds_k = indices[:, :k]  # [batch_size, k]
-
-                # Проверяем, есть ли целевой элемент среди топ-K предсказаний
-                correct = preds_k.eq(targets.view(-1, 1))  # [batch_size, k]
-
-                # Вычисляем Recall@k
-                correct_any = correct.any(dim=1).float()
-                recalls[k] += correct_any.sum().item()
-
-                # Вычисляем NDCG@k
-                # Находим позиции (ранги) целевого элемента в топ-K
-                ranks = torch.where(correct)[1] + 1  # +1 для перехода от индекса к рангу
+            if seen_items is not None:
+                # История всего батча маскируется одним index_put_
+                seen_items.mask_logits(logits, user_ids, targets)
 
-                # Если целевой элемент найден в топ-K, рассчитываем NDCG, иначе 0
-                ndcg_k = (1 / torch.log2(ranks.float() + 1)).sum().item() if ranks.numel() > 0 else 0.0
-
-                # Добавляем метрики для текущего k
-                # recalls[k] += (recall_k)
-                ndcgs[k] += ndcg_k
+            # Ранг цели считается один раз, метрики для всех k - одной тензорной операцией
+            ranking_metrics.update_from_logits(logits, targets)
             # c += 1
             # if c == 3:
             #     break
     # Вычисляем средние значения метрик по всем батчам
-    metrics = {}
-    for k in k_list:
-        # metrics[f'Recall@{k}'] = np.mean(recalls[k])
-        # metrics[f'NDCG@{k}'] = np.mean(ndcgs[k])
-        # metrics[f'fIsIn{k}'] = np.mean(is_in_k[k])
-        metrics[f'Recall@{k}'] = (recalls[k] / len(data_loader.dataset))
-        metrics[f'NDCG@{k}'] = (ndcgs[k] / len(data_loader.dataset))
-        # metrics[f'fIsIn{k}'] = (is_in_k[k]/len(data_loader))
+    metrics = ranking_metrics.compute()
     for loss_name in losses:
         if len(losses[loss_name]) > 0:
-            metrics[loss_name] = np.mean(losses[loss_name])
+            # Среднее по батчам всех процессов: сумма и число батчей складываются по процессам
+            batch_losses = torch.stack(losses[loss_name]).float()
+            totals = all_reduce_sum(torch.stack([batch_losses.sum(), torch.tensor(float(len(batch_losses)),
+                                                                                  device=batch_losses.device)]))
+            metrics[loss_name] = (totals[0] / totals[1]).item()
     return metrics
 
 
 def evaluate_bert4rec_model(model, data_loader, device, mode='validation',
-                            model_criterion=None, criterion_reconstruct_fn=None, user_profile_embeddings=None,
-                            null_profile_binary_mask=None, k_list=[5, 10, 20]):
+                            model_criterion=None, criterion_reconstruct_fn=None, profile_store=None,
+                            k_list=[5, 10, 20], precision='fp32', non_blocking=False, item_chunk_size=None,
+                            seen_items=None, negative_candidates=None):
     """
     Оценивает BERT4Rec модель на заданном наборе данных.
     В этой функции мы фокусируемся на предсказании маскированного токена.
+    precision задаёт точность прямого прохода: 'fp32', 'bf16' или 'fp16'.
+    non_blocking включает асинхронный перенос батчей на устройство (с pin_memory).
+    item_chunk_size включает поблочный скоринг словаря (streaming_target_ranks) без матрицы [batch_size, vocab_size].
+    seen_items (SeenItemIndex) исключает из ранжирования товары из истории пользователя (кроме цели).
+    negative_candidates [num_users, N] включает протокол "1 позитив + N негативов".
     """
     model.eval()
-    recalls = {k: 0 for k in k_list}
-    ndcgs = {k: 0 for k in k_list}
+    ranking_metrics = RankingMetrics(k_list, device=device)
 
     with torch.no_grad():
         for batch in data_loader:
             input_seq, target_seq, attention_mask, user_ids = batch
-            input_seq = input_seq.to(device)
-            target_seq = target_seq.to(device)
-            attention_mask = attention_mask.to(device)
-
-            # Прямой проход
-            outputs = model(input_seq, attention_mask=attention_mask)
-
-            # Если модель возвращает кортеж, извлекаем первый элемент
-            if isinstance(outputs, tuple):
-                outputs = outputs[0]
-
-            # В BERT4Rec для инференса мы предсказываем только последний токен
-            # Находим индекс маскирующего токена для каждой последовательности
-            # Обычно это последний токен в последовательности
-            mask_idx = (input_seq == model.mask_token).nonzero(as_tuple=True)
-            batch_size = input_seq.size(0)
-
-            # Извлекаем логиты для маскирующего токена
-            logits = torch.zeros((batch_size, outputs.size(-1)), device=device)
-
-            for i in range(batch_size):
-                # Находим индексы маскирующих токенов для текущего примера
-                indices = (mask_idx[0] == i).nonzero(as_tuple=True)[0]
-                if indices.size(0) > 0:
-                    # Берем последний маскирующий токен
-                    idx = mask_idx[1][indices[-1]]
-                    logits[i] = outputs[i, idx]
+            input_seq = input_seq.to(device, non_blocking=non_blocking)
+            target_seq = target_seq.to(device, non_blocking=non_blocking)
+            attention_mask = attention_mask.to(device, non_blocking=non_blocking)
+
+            # В BERT4Rec для инференса мы предсказываем только последний маскирующий токен
+            # (в valid/test BERT4RecDataset ставит его на последнюю позицию), поэтому
+            # логиты считаются только для него, без [batch_size, seq_len, vocab_size]
+            if negative_candidates is not None:
+                with get_autocast(device, precision):
+                    last_hidden = model.predict_next(input_seq, attention_mask=attention_mask, apply_head=False)
+                candidates = torch.cat([target_seq[:, -1:], negative_candidates[user_ids.to(device)]], dim=1)
+                scores = candidate_scores(last_hidden, *model.output_embeddings(), candidates)
+                ranking_metrics.update_from_logits(scores, torch.zeros_like(candidates[:, 0]))
+                continue
+
+            if item_chunk_size is not None:
+                with get_autocast(device, precision):
+                    last_hidden = model.predict_next(input_seq, attention_mask=attention_mask, apply_head=False)
+                weight, bias = model.output_embeddings()
+                ranks = streaming_target_ranks(last_hidden, weight, bias, target_seq[:, -1], item_chunk_size)
+                if seen_items is not None:
+                    ranks = seen_items.correct_ranks(ranks, last_hidden, weight, bias, user_ids, target_seq[:, -1])
+                ranking_metrics.update(ranks)
+                continue
+
+            with get_autocast(device, precision):
+                last_hidden = model.predict_next(input_seq, attention_mask=attention_mask, apply_head=False)
+            # Скоринг словаря в fp32 вне autocast: в пониженной точности скоры совпадают со скором цели
+            logits = model.score_hidden(last_hidden.float())  # [batch_size, vocab_size]
 
             # Получаем целевые значения (последний токен в target_seq)
             targets = target_seq[:, -1]
@@ -160,34 +191,10 @@ def evaluate_bert4rec_model(model, data_loader, device, mode='validation',
             # Маскируем паддинг с индексом 0
             logits[:, 0] = -float('inf')
 
-            # Получаем топ-K предсказаний
-            _, indices = torch.topk(logits, max(k_list), dim=1)
-
-            for k in k_list:
-                preds_k = indices[:, :k]  # [batch_size, k]
-
-                # Проверяем, есть ли целевой элемент среди топ-K предсказаний
-                correct = preds_k.eq(targets.view(-1, 1))  # [batch_size, k]
-
-                # Вычисляем Recall@k
-                correct_any = correct.any(dim=1).float()
-                recalls[k] += correct_any.sum().item()
+            if seen_items is not None:
+                seen_items.mask_logits(logits, user_ids, targets)
 
-                # Вычисляем NDCG@k
-                # Находим позиции (ранги) целевого элемента в топ-K
-                ranks = torch.where(correct)[1] + 1  # +1 для перехода от индекса к рангу
-
-                # Если целевой элемент найден в топ-K, рассчитываем NDCG, иначе 0
-                ndcg_k = (1 / torch.log2(ranks.float() + 1)).sum().item() if ranks.numel() > 0 else 0.0
-
-                # Добавляем метрики для текущего k
-                # recalls[k] += (recall_k)
-                ndcgs[k] += ndcg_k
+            ranking_metrics.update_from_logits(logits, targets)
 
     # Вычисляем средние значения метрик
-    metrics = {}
-    for k in k_list:
-        metrics[f'Recall@{k}'] = recalls[k] / len(data_loader.dataset)
-        metrics[f'NDCG@{k}'] = ndcgs[k] / len(data_loader.dataset)
-
-    return metrics
\ No newline at end of file
+    return ranking_metrics.compute()
@@ -0,0 +1,120 @@
+# src/export_model.py
+
+import argparse
+import pickle
+
+import torch
+import torch.nn as nn
+import yaml
+
+from src.training import get_model
+
+
+EXPORT_FORMATS = ['torchscript', 'export']
+
+
+class TopKRecommender(nn.Module):
+    """
+    Граф инференса для сервинга: история [batch_size, maxlen - 1] (паддинг нулями слева) => top-k товаров.
+
+    Для BERT4Rec (mask_token задан) в конец истории дописывается маскирующий токен, как в BERT4RecDataset
+    в режиме valid/test. Паддинг и маскирующий токен в выдачу не попадают.
+    Возвращает (scores [batch_size, top_k], item_ids [batch_size, top_k]).
+    """
+
+    def __init__(self, model, item_num, top_k=10, mask_token=None):
+        super(TopKRecommender, self).__init__()
+        self.model = model
+        self.item_num = item_num
+        self.top_k = top_k
+        self.mask_token = mask_token
+
+    def forward(self, input_ids):
+        if self.mask_token is not None:
+            mask_column = torch.full_like(input_ids[:, :1], self.mask_token)
+            input_seq = torch.cat([input_ids, mask_column], dim=1)
+            logits = self.model.predict_next(input_seq, attention_mask=(input_seq != 0).long())
+        else:
+            logits = self.model.predict_next(input_ids)
+
+        # Столбец 0 - паддинг, столбцы после item_num - маскирующий токен BERT4Rec
+        scores, indices = torch.topk(logits[:, 1:self.item_num + 1], self.top_k, dim=-1)
+        return scores, indices + 1
+
+
+def infer_profile_emb_dim(state_dict, hidden_units):
+    """Размерность эмбеддингов профиля по весам LLM-модели (в сохранённой модели она не хранится отдельно)."""
+    if 'profile_transform.weight' in state_dict:
+        return state_dict['profile_transform.weight'].size(1)
+    if 'hidden_layer_transform.weight' in state_dict:
+        return state_dict['hidden_layer_transform.weight'].size(0)
+    if 'profile_aggregator.attention.weight' in state_dict:
+        return state_dict['profile_aggregator.attention.weight'].size(1)
+    # Слоёв, зависящих от размерности профиля, нет - для инференса она не важна
+    return hidden_units
+
+
+def load_trained_model(config, model_path, device):
+    """Восстанавливает модель из конфига обучения и сохранённого state_dict (*_model.pt)."""
+    with open(config['data']['counts'], 'rb') as f:
+        num_users, num_items = pickle.load(f)
+    config['model']['item_num'] = num_items
+    config['model']['user_num'] = num_users
+
+    model_name = config['model']['model_name']
+    if model_name in ['BERT4Rec', 'BERT4RecLLM']:
+        config['model']['mask_token'] = num_items + 1
+        config['model']['vocab_size'] = num_items + 2
+
+    state_dict = torch.load(model_path, map_location=device)
+    profile_emb_dim = None
+    if model_name in ['SASRecLLM', 'BERT4RecLLM']:
+        profile_emb_dim = infer_profile_emb_dim(state_dict, config['model']['hidden_units'])
+
+    model = get_model(model_name, config, device, profile_emb_dim=profile_emb_dim)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def export_model(config, model_path, output_path, export_format='torchscript', top_k=10, device='cpu'):
+    """
+    Сохраняет граф инференса TopKRecommender: TorchScript (torch.jit.trace) или torch.export (.pt2)
+    с динамическим размером батча. Загрузка: torch.jit.load(path) или torch.export.load(path).module().
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {export_format}')
+
+    device = torch.device(device)
+    model = load_trained_model(config, model_path, device)
+    item_num = config['model']['item_num']
+    recommender = TopKRecommender(model, item_num, top_k=top_k,
+                                  mask_token=config['model'].get('mask_token')).eval()
+
+    example_input = torch.randint(1, item_num + 1, (2, config['model']['maxlen'] - 1), device=device)
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            traced = torch.jit.trace(recommender, example_input, strict=False)
+            traced.save(output_path)
+        else:
+            batch = torch.export.Dim('batch', min=1)
+            exported = torch.export.export(recommender, (example_input,), dynamic_shapes=({0: batch},))
+            torch.export.save(exported, output_path)
+    print(f'Exported {config["model"]["model_name"]} ({export_format}, top_k={top_k}) to {output_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a trained model as a top-k inference graph")
+    parser.add_argument('--config', type=str, required=True, help="Path to the training config file")
+    parser.add_argument('--model-path', type=str, required=True, help="Path to the saved *_model.pt state dict")
+    parser.add_argument('--output', type=str, required=True, help="Path to the exported artifact")
+    parser.add_argument('--format', type=str, default='torchscript', choices=EXPORT_FORMATS,
+                        help="torchscript (torch.jit.trace) or export (torch.export, .pt2)")
+    parser.add_argument('--top-k', type=int, default=10, help="Number of recommended items")
+    parser.add_argument('--device', type=str, default='cpu', help="Device to trace the model on")
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    export_model(config, args.model_path, args.output, export_format=args.format, top_k=args.top_k,
+                 device=args.device)
@@ -0,0 +1,34 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.utils import save_profile_embeddings_npy
+
+
+def convert_embeddings(json_path, npy_path):
+    """
+    One-time conversion of a JSON embeddings file {user_id: [..]} into the binary format
+    read by src.utils.read_profile_embeddings: <name>.npy + <name>.ids.json.
+    """
+    with open(json_path, 'r') as f:
+        user2embs = json.load(f)
+
+    users = list(user2embs.keys())
+    embs = np.asarray(list(user2embs.values()), dtype=np.float32)
+    del user2embs
+
+    save_profile_embeddings_npy(users, embs, npy_path)
+    print(f'Saved {embs.shape[0]} embeddings of dim {embs.shape[1]} to {npy_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert JSON profile embeddings to the binary .npy format.")
+    parser.add_argument('--json_path', type=str, required=True, help='Path to the JSON embeddings file')
+    parser.add_argument('--npy_path', type=str, default=None,
+                        help='Path to the output .npy file (defaults to the JSON path with .npy extension)')
+
+    args = parser.parse_args()
+    npy_path = args.npy_path or os.path.splitext(args.json_path)[0] + '.npy'
+    convert_embeddings(args.json_path, npy_path)
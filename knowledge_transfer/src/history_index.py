@@ -0,0 +1,78 @@
+# src/history_index.py
+
+import numpy as np
+import torch
+
+
+def build_history_csr(sequences, num_users, drop_last=1):
+    """
+    CSR-индекс истории пользователей по словарю {user_id: [items]}.
+
+    История - все товары последовательности, кроме последних drop_last (оцениваемой цели);
+    повторы убираются, внутри строки товары отсортированы.
+
+    Returns:
+        indptr [num_users + 1] int64 и indices [nnz] int64: товары пользователя u - indices[indptr[u]:indptr[u + 1]].
+    """
+    num_users = max([num_users] + [user_id + 1 for user_id in sequences])
+    lengths = np.zeros(num_users, dtype=np.int64)
+    rows = {}
+    for user_id, seq in sequences.items():
+        history = np.unique(np.asarray(seq[:len(seq) - drop_last], dtype=np.int64))
+        rows[user_id] = history[history != 0]
+        lengths[user_id] = len(rows[user_id])
+
+    indptr = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.zeros(indptr[-1], dtype=np.int64)
+    for user_id, history in rows.items():
+        indices[indptr[user_id]:indptr[user_id + 1]] = history
+    return indptr, indices
+
+
+class SeenItemIndex:
+    """
+    История взаимодействий пользователей в формате CSR (indptr/indices) на устройстве - для фильтрации
+    уже просмотренных товаров при оценке.
+
+    Координаты (строка батча, товар) всего батча собираются векторно, и логиты маскируются одним
+    index_put_; сама цель не фильтруется, даже если встречалась в истории.
+    """
+
+    def __init__(self, indptr, indices, device):
+        self.device = device
+        self.indptr = torch.as_tensor(np.asarray(indptr), dtype=torch.long).to(device)
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long).to(device)
+
+    def batch_coordinates(self, user_ids):
+        """Пары (строка батча [nnz], товар [nnz]) истории пользователей user_ids [batch_size]."""
+        user_ids = user_ids.to(self.device)
+        starts = self.indptr[user_ids]
+        lengths = self.indptr[user_ids + 1] - starts
+        rows = torch.repeat_interleave(torch.arange(len(user_ids), device=self.device), lengths)
+        # Позиция внутри строки: сквозной номер минус смещение начала строки в батче
+        batch_offsets = torch.cumsum(lengths, dim=0) - lengths
+        positions = torch.arange(rows.numel(), device=self.device) - batch_offsets[rows]
+        return rows, self.indices[starts[rows] + positions]
+
+    def mask_logits(self, logits, user_ids, targets):
+        """Ставит -inf в logits [batch_size, num_items] на просмотренные товары (кроме targets), на месте."""
+        rows, items = self.batch_coordinates(user_ids)
+        keep = items != targets[rows]
+        logits.index_put_((rows[keep], items[keep]), torch.tensor(-float('inf'), device=logits.device))
+        return logits
+
+    def correct_ranks(self, ranks, hidden, weight, bias, user_ids, targets):
+        """
+        Поправка рангов из streaming_target_ranks: вычитает просмотренные товары со скором не ниже цели,
+        не строя матрицу логитов (скор считается только для пар истории).
+        """
+        rows, items = self.batch_coordinates(user_ids)
+        hidden = hidden.float()
+        seen_scores = (hidden[rows] * weight[items].float()).sum(dim=-1)
+        target_scores = (hidden * weight[targets].float()).sum(dim=-1)
+        if bias is not None:
+            seen_scores = seen_scores + bias[items].float()
+            target_scores = target_scores + bias[targets].float()
+        better = (seen_scores >= target_scores[rows]) & (items != targets[rows])
+        return ranks - torch.zeros_like(ranks).index_add_(0, rows, better.long())
@@ -0,0 +1,159 @@
+# src/losses.py
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from src.data_cache import load_item_counts
+
+
+SAMPLED_RECSYS_LOSSES = ['uniform', 'popularity', 'in_batch', 'gbce']
+
+
+class SampledRecsysLoss(nn.Module):
+    """
+    Рекомендательный лосс, который скорит только подвыборку товаров вместо всего каталога.
+
+    Принимает скрытые состояния [N, hidden_units] (а не логиты [N, num_items]) и цели [N],
+    поэтому совместим с `calculate_recsys_loss`. Веса выходной проекции берутся из модели
+    через `output_embeddings_fn` (например, `model.output_embeddings`).
+
+    Типы лосса:
+        uniform    - sampled softmax с равномерно сэмплированными негативами;
+        popularity - sampled softmax с негативами по популярности и logQ-коррекцией;
+        in_batch   - softmax по уникальным целям батча с logQ-коррекцией по популярности;
+        gbce       - generalized BCE (gSASRec) с равномерными негативами.
+    """
+
+    def __init__(self, loss_type, output_embeddings_fn, item_num, num_negatives=256,
+                 ignore_index=0, item_counts=None, gbce_t=0.75):
+        super(SampledRecsysLoss, self).__init__()
+        if loss_type not in SAMPLED_RECSYS_LOSSES:
+            raise NotImplementedError(f'No such recsys_loss {loss_type} exists')
+        if loss_type in ['popularity', 'in_batch'] and item_counts is None:
+            raise ValueError(f'recsys_loss {loss_type} requires item_counts')
+
+        self.loss_type = loss_type
+        self.output_embeddings_fn = output_embeddings_fn
+        self.item_num = item_num
+        self.num_negatives = num_negatives
+        self.ignore_index = ignore_index
+        self.gbce_t = gbce_t
+
+        if item_counts is not None:
+            # Распределение сэмплирования по товарам 1..item_num со сглаживанием +1
+            # (паддинг 0 никогда не сэмплируется)
+            probs = torch.as_tensor(item_counts, dtype=torch.float)[:item_num + 1] + 1
+            probs[0] = 0
+            probs = probs / probs.sum()
+            self.register_buffer('item_probs', probs)
+            self.register_buffer('item_log_probs', torch.log(probs).clamp(min=-1e4))
+        else:
+            self.item_log_probs = None
+            self.item_probs = None
+
+    def _sample_negatives(self, device):
+        if self.loss_type == 'popularity':
+            return torch.multinomial(self.item_probs, self.num_negatives, replacement=True).to(device)
+        return torch.randint(1, self.item_num + 1, (self.num_negatives,), device=device)
+
+    def forward(self, hidden, targets):
+        """
+        hidden: [N, hidden_units], targets: [N]
+        """
+        weight, bias = self.output_embeddings_fn()
+
+        valid = targets != self.ignore_index
+        hidden = hidden[valid]
+        targets = targets[valid]
+        if targets.numel() == 0:
+            return hidden.sum() * 0.0
+
+        pos_logits = (hidden * weight[targets]).sum(dim=-1)  # [N]
+        if bias is not None:
+            pos_logits = pos_logits + bias[targets]
+
+        if self.loss_type == 'in_batch':
+            # Кандидаты - уникальные цели батча, позитив - индекс своей цели среди них
+            candidates, labels = torch.unique(targets, return_inverse=True)
+            logits = hidden @ weight[candidates].T  # [N, C]
+            if bias is not None:
+                logits = logits + bias[candidates]
+            logits = logits - self.item_log_probs[candidates].to(logits.dtype)
+            return F.cross_entropy(logits, labels)
+
+        negatives = self._sample_negatives(hidden.device)  # [num_negatives], общие для всего батча
+        neg_logits = hidden @ weight[negatives].T  # [N, num_negatives]
+        if bias is not None:
+            neg_logits = neg_logits + bias[negatives]
+        # Случайные попадания позитива в негативы не должны штрафоваться
+        accidental_hits = negatives.view(1, -1) == targets.view(-1, 1)
+
+        if self.loss_type == 'gbce':
+            return self._gbce(pos_logits, neg_logits, accidental_hits)
+
+        if self.loss_type == 'popularity':
+            log_expected = self.item_log_probs + np.log(self.num_negatives)
+            pos_logits = pos_logits - log_expected[targets].to(pos_logits.dtype)
+            neg_logits = neg_logits - log_expected[negatives].to(neg_logits.dtype)
+
+        neg_logits = neg_logits.masked_fill(accidental_hits, torch.finfo(neg_logits.dtype).min)
+        logits = torch.cat([pos_logits.unsqueeze(1), neg_logits], dim=1)  # [N, 1 + num_negatives]
+        labels = torch.zeros(logits.size(0), dtype=torch.long, device=logits.device)
+        return F.cross_entropy(logits, labels)
+
+    def _gbce(self, pos_logits, neg_logits, accidental_hits):
+        """gBCE из gSASRec (Petrov & Macdonald, 2023): BCE с откалиброванной вероятностью позитива."""
+        alpha = self.num_negatives / (self.item_num - 1)
+        beta = alpha * (self.gbce_t * (1 - 1 / alpha) + 1 / alpha)
+        eps = 1e-10
+
+        pos_logits = pos_logits.double()
+        pos_probs = torch.clamp(torch.sigmoid(pos_logits), eps, 1 - eps)
+        pos_probs_adjusted = torch.clamp(pos_probs.pow(-beta), 1 + eps, torch.finfo(torch.float64).max)
+        to_log = torch.clamp(1.0 / (pos_probs_adjusted - 1), eps, torch.finfo(torch.float64).max)
+        pos_logits_transformed = to_log.log().to(neg_logits.dtype)
+
+        pos_loss = F.binary_cross_entropy_with_logits(pos_logits_transformed, torch.ones_like(pos_logits_transformed))
+        neg_loss = F.binary_cross_entropy_with_logits(neg_logits, torch.zeros_like(neg_logits), reduction='none')
+        neg_loss = neg_loss.masked_fill(accidental_hits, 0.0).sum(dim=1).mean()
+        return pos_loss + neg_loss
+
+
+def compute_item_counts(sequences, item_num):
+    """Частоты товаров по словарю последовательностей {user_id: [item, ...]} => np.ndarray [item_num + 1]."""
+    all_items = np.fromiter((item for seq in sequences.values() for item in seq), dtype=np.int64)
+    return np.bincount(all_items, minlength=item_num + 1)[:item_num + 1]
+
+
+def init_criterion_recsys(config, model, train_sequences=None):
+    """
+    Создаёт рекомендательный лосс по config['training']['recsys_loss'].
+
+    'full' (по умолчанию) - CrossEntropyLoss по всему каталогу (логиты), иначе - SampledRecsysLoss
+    (скрытые состояния, см. `model.forward(..., apply_head=False)`).
+    Частоты товаров считаются по config['data']['profile_train_sequences'] (train_sequences, если уже загружены)
+    и кэшируются вместе с остальными данными.
+    """
+    model_name = config['model']['model_name']
+    loss_type = config['training'].get('recsys_loss', 'full')
+    # Для BERT4Rec игнорируем токены с target -100, для SASRec - паддинги (0)
+    ignore_index = -100 if model_name in ['BERT4Rec', 'BERT4RecLLM'] else 0
+
+    if loss_type == 'full':
+        return nn.CrossEntropyLoss(ignore_index=ignore_index)
+
+    item_num = config['model']['item_num']
+    item_counts = None
+    if loss_type in ['popularity', 'in_batch']:
+        item_counts = load_item_counts(config, 'profile_train_sequences', item_num, sequences=train_sequences)
+    return SampledRecsysLoss(
+        loss_type,
+        output_embeddings_fn=model.output_embeddings,
+        item_num=item_num,
+        num_negatives=config['training'].get('num_negatives', 256),
+        ignore_index=ignore_index,
+        item_counts=item_counts,
+        gbce_t=config['training'].get('gbce_t', 0.75),
+    ).to(next(model.parameters()).device)
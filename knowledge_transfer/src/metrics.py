@@ -0,0 +1,147 @@
+# src/metrics.py
+
+import torch
+
+from src.distributed import all_reduce_sum
+
+
+class RankingMetrics:
+    """
+    Накопитель ранжирующих метрик для сценария с одним целевым элементом на пользователя.
+
+    Ранг цели вычисляется один раз на батч, после чего Recall/HitRate/NDCG/MRR для всех k
+    считаются одной тензорной операцией. Суммы хранятся на устройстве и переносятся на хост
+    только в `compute()`, поэтому в цикле оценки нет синхронизаций на каждый батч.
+
+    Так как цель одна, Recall@k совпадает с HitRate@k; обе метрики сохранены для совместимости
+    с логами MLflow.
+
+    При распределённой оценке каждый процесс накапливает свою часть пользователей, а `compute()`
+    суммирует накопители по процессам.
+    """
+
+    def __init__(self, k_list, device=None):
+        self.k_list = list(k_list)
+        self.device = device
+        self.k = torch.tensor(self.k_list, dtype=torch.long, device=device)  # [K]
+        self.hits = torch.zeros(len(self.k_list), dtype=torch.float64, device=device)
+        self.ndcg = torch.zeros(len(self.k_list), dtype=torch.float64, device=device)
+        self.mrr = torch.zeros(len(self.k_list), dtype=torch.float64, device=device)
+        self.count = 0
+
+    @staticmethod
+    def target_ranks(logits, targets):
+        """
+        Ранг (начиная с 1) целевого элемента в строке логитов.
+
+        Args:
+            logits (torch.Tensor): [batch_size, num_items]
+            targets (torch.Tensor): [batch_size]
+
+        Returns:
+            torch.Tensor: [batch_size], ранг = 1 + число других элементов со скором не меньше, чем у цели.
+            Ничьи считаются против цели (иначе в bf16/fp16 совпадающие скоры завышают метрики),
+            а строка с NaN-скором цели получает худший ранг num_items.
+        """
+        target_scores = logits.gather(1, targets.view(-1, 1))  # [batch_size, 1]
+        # Сама цель тоже попадает в >=, она и даёт слагаемое 1
+        ranks = (logits >= target_scores).sum(dim=1)
+        return torch.where(torch.isnan(target_scores.squeeze(1)), logits.size(1), ranks)
+
+    def update_from_logits(self, logits, targets):
+        """Добавляет батч по логитам [batch_size, num_items] и целям [batch_size]."""
+        self.update(self.target_ranks(logits, targets))
+
+    def update(self, ranks):
+        """
+        Добавляет батч по уже посчитанным рангам цели.
+
+        Args:
+            ranks (torch.Tensor): [batch_size], ранги цели начиная с 1.
+        """
+        ranks = ranks.to(self.k.device)
+        in_top_k = (ranks.view(-1, 1) <= self.k).double()  # [batch_size, K]
+        ranks = ranks.double()
+
+        self.hits += in_top_k.sum(dim=0)
+        self.ndcg += (in_top_k / torch.log2(ranks + 1).view(-1, 1)).sum(dim=0)
+        self.mrr += (in_top_k / ranks.view(-1, 1)).sum(dim=0)
+        self.count += ranks.numel()
+
+    def compute(self):
+        """Возвращает словарь средних значений метрик (единственная синхронизация с хостом)."""
+        # [hits, ndcg, mrr, count] одним all_reduce (без распределённого режима - без изменений)
+        totals = torch.cat([self.hits, self.ndcg, self.mrr,
+                            torch.tensor([self.count], dtype=torch.float64, device=self.hits.device)])
+        totals = all_reduce_sum(totals)
+        num_k = len(self.k_list)
+        count = max(totals[-1].item(), 1)
+        hits = (totals[:num_k] / count).tolist()
+        ndcg = (totals[num_k:2 * num_k] / count).tolist()
+        mrr = (totals[2 * num_k:3 * num_k] / count).tolist()
+
+        metrics = {}
+        for i, k in enumerate(self.k_list):
+            metrics[f'Recall@{k}'] = hits[i]
+            metrics[f'NDCG@{k}'] = ndcg[i]
+            metrics[f'HitRate@{k}'] = hits[i]
+            metrics[f'MRR@{k}'] = mrr[i]
+        return metrics
+
+
+def streaming_target_ranks(hidden, weight, bias, targets, chunk_size, excluded_items=(0,)):
+    """
+    Ранги целей (как RankingMetrics.target_ranks: ничьи против цели, NaN-цель - худший ранг)
+    без плотной матрицы логитов [batch_size, num_items]:
+    каталог скорится блоками по chunk_size строк выходной проекции, память не зависит от размера каталога.
+
+    Args:
+        hidden (torch.Tensor): [batch_size, hidden_units]
+        weight (torch.Tensor): [num_items, hidden_units] - item_emb.weight (SASRec) или out.weight (BERT4Rec)
+        bias (torch.Tensor): [num_items] или None
+        targets (torch.Tensor): [batch_size]
+        chunk_size (int): число товаров в блоке
+        excluded_items: товары, которые не ранжируются (паддинг 0, как logits[:, 0] = -inf в плотном пути)
+
+    Returns:
+        ranks [batch_size].
+    """
+    hidden = hidden.float()
+    target_scores = (hidden * weight[targets].float()).sum(dim=-1)  # [batch_size]
+    if bias is not None:
+        target_scores = target_scores + bias[targets].float()
+
+    ranks = torch.ones_like(targets)
+    for start in range(0, weight.size(0), chunk_size):
+        end = min(start + chunk_size, weight.size(0))
+        scores = hidden @ weight[start:end].float().T  # [batch_size, chunk]
+        if bias is not None:
+            scores = scores + bias[start:end].float()
+        for item in excluded_items:
+            if start <= item < end:
+                scores[:, item - start] = -float('inf')
+
+        item_ids = torch.arange(start, end, device=hidden.device)
+        # Цель не сравнивается сама с собой: её скор в блоке может отличаться от target_scores в последнем бите
+        better = (scores >= target_scores.unsqueeze(1)) & (item_ids.unsqueeze(0) != targets.unsqueeze(1))
+        ranks += better.sum(dim=1)
+    return torch.where(torch.isnan(target_scores), weight.size(0), ranks)
+
+
+def candidate_scores(hidden, weight, bias, candidates):
+    """
+    Скоры только для заданных товаров (без умножения на весь каталог).
+
+    Args:
+        hidden (torch.Tensor): [batch_size, hidden_units]
+        weight (torch.Tensor): [num_items, hidden_units] - выходная проекция (см. output_embeddings)
+        bias (torch.Tensor): [num_items] или None
+        candidates (torch.Tensor): [batch_size, num_candidates]
+
+    Returns:
+        torch.Tensor: [batch_size, num_candidates] float32
+    """
+    scores = torch.einsum('bh,bch->bc', hidden.float(), weight[candidates].float())
+    if bias is not None:
+        scores = scores + bias[candidates].float()
+    return scores
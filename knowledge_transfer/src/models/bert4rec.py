@@ -51,11 +51,20 @@ class BERT4Rec(nn.Module):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
-    def forward(self, input_seq, attention_mask=None, user_profile_emb=None):
+    def output_embeddings(self):
+        """Веса и смещение выходной проекции: ([vocab_size, hidden_units], [vocab_size])."""
+        return self.out.weight, self.out.bias
+
+    def score_hidden(self, hidden):
+        """Применяет выходную голову к скрытым состояниям [..., hidden_units] => [..., vocab_size]."""
+        return self.out(hidden)
+
+    def forward(self, input_seq, attention_mask=None, user_profile_emb=None, apply_head=True):
         """
         input_seq: Tensor с индексами товаров [batch_size, seq_len]
         attention_mask: Attention mask [batch_size, seq_len] или None
         user_profile_emb: Не используется в классической модели BERT4Rec
+        apply_head: если False, возвращаются скрытые состояния вместо логитов (для сэмплированных лоссов)
         """
         attention_mask = (input_seq != 0).long()  # [batch_size, seq_len]
         if attention_mask is None:
@@ -65,11 +74,37 @@ class BERT4Rec(nn.Module):
         outputs = self.bert(input_ids=input_seq, attention_mask=attention_mask)
         sequence_output = outputs.last_hidden_state  # [batch_size, seq_len, hidden_units]
 
-        if self.add_head:
+        if self.add_head and apply_head:
             # Предсказание следующего товара
-            logits = self.out(sequence_output)  # [batch_size, seq_len, item_num + 1]
+            logits = self.score_hidden(sequence_output)  # [batch_size, seq_len, item_num + 1]
         else:
             logits = sequence_output  # [batch_size, seq_len, hidden_units]
 
         # Возвращаем формат: (outputs, reconstructed_profile)
-        return logits, None
\ No newline at end of file
+        return logits, None
+
+    def predict_next(self, input_seq, attention_mask=None, apply_head=True):
+        """
+        Инференс: логиты только для последнего маскирующего токена каждой последовательности.
+
+        В отличие от forward, через self.out проецируется одно скрытое состояние на пример,
+        поэтому тензор [batch_size, seq_len, vocab_size] не материализуется.
+
+        input_seq: Tensor с индексами товаров [batch_size, seq_len]
+        attention_mask: Attention mask [batch_size, seq_len] или None
+        apply_head: если False, возвращается скрытое состояние (для поблочного скоринга каталога)
+        Возвращает: [batch_size, vocab_size] (или [batch_size, hidden_units] без головы)
+        """
+        if attention_mask is None:
+            attention_mask = (input_seq != 0).long()  # [batch_size, seq_len]
+
+        sequence_output = self.bert(input_ids=input_seq, attention_mask=attention_mask).last_hidden_state
+
+        # Позиция последнего маскирующего токена (в valid/test это последняя позиция)
+        positions = torch.arange(input_seq.size(1), device=input_seq.device)
+        mask_positions = ((input_seq == self.mask_token).long() * positions).argmax(dim=1)  # [batch_size]
+        last_hidden = sequence_output[torch.arange(input_seq.size(0), device=input_seq.device), mask_positions]
+
+        if self.add_head and apply_head:
+            return self.score_hidden(last_hidden)  # [batch_size, vocab_size]
+        return last_hidden  # [batch_size, hidden_units]
\ No newline at end of file
@@ -108,12 +108,16 @@ class BERT4RecLLM(BERT4Rec):
                                              *self.multi_profile_weighting_kwargs)  # => [bsz, emb_dim_now])
         return aggregated
 
-    def forward(self, input_seq, user_profile_emb=None, attention_mask=None, return_hidden_states=False):
+    def forward(self, input_seq, user_profile_emb=None, attention_mask=None, return_hidden_states=False,
+                apply_head=True, compute_reconstruction=True):
         """
         Args:
             input_seq: [batch_size, seq_len]
             user_profile_emb: [batch_size, emb_dim] или [batch_size, K, emb_dim]
             attention_mask (torch.Tensor): Маска внимания [batch_size, seq_len].
+            apply_head (bool): если False, вместо логитов возвращаются скрытые состояния.
+            compute_reconstruction (bool): если False (фаза без guide-лосса), скрытые состояния слоёв
+                не запрашиваются у BERT, а вместо reconstruction_input возвращается None.
         """
         # 1) Сначала можем агрегировать профили, если нужно.
         # user_profile_emb_agg = self.aggregate_profile(user_profile_emb)
@@ -129,25 +133,29 @@ class BERT4RecLLM(BERT4Rec):
         if attention_mask is None:
             attention_mask = (input_seq != 0).long()  # [batch_size, seq_len]
 
+        # Все слои нужны только для reconstruction_layer != -1, последний слой - это last_hidden_state
+        output_hidden_states = compute_reconstruction and self.reconstruction_layer != -1
         outputs = self.bert(
             input_ids=input_seq,
             attention_mask=attention_mask,
-            output_hidden_states=True
+            output_hidden_states=output_hidden_states
         )
         sequence_output = outputs.last_hidden_state  # [batch_size, seq_len, hidden_units]
 
         # 3) Логиты или фичи
-        if self.add_head:
-            logits = self.out(sequence_output)  # [batch_size, seq_len, vocab_size]
+        if self.add_head and apply_head:
+            logits = self.score_hidden(sequence_output)  # [batch_size, seq_len, vocab_size]
         else:
             logits = sequence_output  # [batch_size, seq_len, hidden_units]
 
-        hidden_states = outputs.hidden_states  # tuple всех слоёв [batch_size, seq_len, hidden_units]
+        if not compute_reconstruction:
+            return logits, None
 
         # 4) Выбор слоя для reconstruction
         if self.reconstruction_layer == -1:
-            selected_hidden_state = hidden_states[-1]  # финальный
+            selected_hidden_state = sequence_output  # финальный
         else:
+            hidden_states = outputs.hidden_states  # tuple всех слоёв [batch_size, seq_len, hidden_units]
             selected_hidden_state = hidden_states[self.reconstruction_layer]
 
         # 5) Агрегация (mean/attention) item-секвенции => reconstruction_input
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 from src.models.utils import mean_weightening
@@ -28,11 +29,16 @@ class PointWiseFeedForward(nn.Module):
         outputs += inputs
         return outputs
 
+ATTENTION_IMPLEMENTATIONS = ['mha', 'sdpa']
+
+
 class SASRec(nn.Module):
     def __init__(self, item_num, maxlen=50, hidden_units=64,
                  num_blocks=2, num_heads=2, dropout_rate=0.2,
-                 initializer_range=0.02, add_head=True):
+                 initializer_range=0.02, add_head=True, attention_impl='mha', mask_padding=False):
         super(SASRec, self).__init__()
+        if attention_impl not in ATTENTION_IMPLEMENTATIONS:
+            raise NotImplementedError(f'No such attention_impl {attention_impl} exists')
 
         self.item_num = item_num
         self.maxlen = maxlen
@@ -42,6 +48,11 @@ class SASRec(nn.Module):
         self.dropout_rate = dropout_rate
         self.initializer_range = initializer_range
         self.add_head = add_head
+        # 'mha' - nn.MultiheadAttention, 'sdpa' - F.scaled_dot_product_attention с теми же весами
+        self.attention_impl = attention_impl
+        # Маскировать паддинг как ключи внимания (нужно, чтобы батчи, обрезанные по самой длинной
+        # последовательности, давали тот же результат, что и полные)
+        self.mask_padding = mask_padding
 
         self.item_emb = nn.Embedding(item_num + 1, hidden_units, padding_idx=0)
         self.pos_emb = nn.Embedding(maxlen, hidden_units)
@@ -85,14 +96,17 @@ class SASRec(nn.Module):
             nn.init.ones_(module.weight)
             nn.init.zeros_(module.bias)
 
-    def forward(self, input_ids, user_profile_emb=None):
+    def log2feats(self, input_ids, user_profile_emb=None):
+        """
+        Прогоняет последовательность через блоки SASRec.
+
+        input_ids: [batch_size, seq_len]
+        Возвращает: [batch_size, seq_len, hidden_units] после последнего LayerNorm.
+        """
         seqs = self.item_emb(input_ids)
         seqs *= self.hidden_units ** 0.5
 
-        batch_size, seq_len = input_ids.size()
-        positions = torch.arange(seq_len, dtype=torch.long,
-                                 device=input_ids.device).unsqueeze(0).expand(batch_size, -1)
-        seqs += self.pos_emb(positions)
+        seqs += self.pos_emb(self.position_ids(input_ids))
 
         if user_profile_emb is not None:
             seqs += user_profile_emb.unsqueeze(1)
@@ -102,33 +116,125 @@ class SASRec(nn.Module):
         timeline_mask = (input_ids == 0)
         seqs *= ~timeline_mask.unsqueeze(-1)
 
-        tl = seqs.shape[1]
-        attention_mask = ~torch.tril(
-            torch.ones((tl, tl), dtype=torch.bool, device=seqs.device)
-        )
+        attention_mask = self.causal_attention_mask(seqs, timeline_mask)
 
         for i in range(len(self.attention_layers)):
-            seqs = seqs.transpose(0, 1)
-            Q = self.attention_layernorms[i](seqs)
-            mha_outputs, _ = self.attention_layers[i](
-                Q, seqs, seqs, attn_mask=attention_mask
-            )
-            seqs = Q + mha_outputs
-            seqs = seqs.transpose(0, 1)
+            seqs = self.self_attention(i, seqs, attention_mask)
             seqs = self.forward_layernorms[i](seqs)
             seqs = self.forward_layers[i](seqs)
             seqs *= ~timeline_mask.unsqueeze(-1)
 
-        outputs = self.last_layernorm(seqs)
+        return self.last_layernorm(seqs)
+
+    def position_ids(self, input_ids):
+        """
+        Позиции [batch_size, seq_len], выровненные по правому краю окна длины maxlen - 1 (длина входа SequenceDataset).
+        Для полного входа это 0..seq_len-1, как и раньше, а у батча, обрезанного слева до самой длинной
+        последовательности, товары сохраняют те же позиции.
+        """
+        batch_size, seq_len = input_ids.size()
+        offset = max(self.maxlen - 1 - seq_len, 0)
+        positions = torch.arange(offset, offset + seq_len, dtype=torch.long, device=input_ids.device)
+        return positions.unsqueeze(0).expand(batch_size, -1)
+
+    def causal_attention_mask(self, seqs, timeline_mask=None):
+        """
+        Маска внимания для self_attention.
+
+        Без mask_padding: для 'mha' причинная маска [seq_len, seq_len] (True - запрещённые позиции),
+        для 'sdpa' - None (is_causal=True).
+        С mask_padding: причинная маска, дополнительно закрывающая паддинг-ключи (timeline_mask [batch_size, seq_len]).
+        Позиция паддинга видит только себя, чтобы строка маски не была пустой. Для 'sdpa' -
+        [batch_size, 1, seq_len, seq_len] (True - разрешённые позиции), для 'mha' - [batch_size * num_heads, seq_len, seq_len].
+        """
+        tl = seqs.shape[1]
+        if not self.mask_padding:
+            if self.attention_impl == 'sdpa':
+                return None
+            return ~torch.tril(torch.ones((tl, tl), dtype=torch.bool, device=seqs.device))
+
+        eye = torch.eye(tl, dtype=torch.bool, device=seqs.device)
+        allowed = torch.tril(torch.ones((tl, tl), dtype=torch.bool, device=seqs.device))
+        allowed = allowed & (~timeline_mask.unsqueeze(1) | eye)  # [batch_size, seq_len, seq_len]
+        if self.attention_impl == 'sdpa':
+            return allowed.unsqueeze(1)
+        return (~allowed).repeat_interleave(self.num_heads, dim=0)
+
+    def self_attention(self, i, seqs, attention_mask):
+        """
+        Причинное self-attention i-го блока с residual: seqs [batch_size, seq_len, hidden_units] => то же.
+        """
+        Q = self.attention_layernorms[i](seqs)
+
+        if self.attention_impl == 'sdpa':
+            return Q + self._sdpa_attention(self.attention_layers[i], Q, seqs, attention_mask)
+
+        seqs = seqs.transpose(0, 1)
+        Q = Q.transpose(0, 1)
+        mha_outputs, _ = self.attention_layers[i](
+            Q, seqs, seqs, attn_mask=attention_mask
+        )
+        return (Q + mha_outputs).transpose(0, 1)
+
+    def _sdpa_attention(self, layer, query, key_value, attention_mask=None):
+        """
+        То же, что nn.MultiheadAttention(query, key_value, key_value) с причинной маской, но batch-first
+        через F.scaled_dot_product_attention. Используются веса самого layer, поэтому чекпоинты совместимы.
+        attention_mask=None - чисто причинное внимание (is_causal=True), иначе маска из causal_attention_mask.
+        """
+        batch_size, seq_len, hidden_units = query.shape
+        head_dim = hidden_units // self.num_heads
+
+        q = F.linear(query, layer.in_proj_weight[:hidden_units], layer.in_proj_bias[:hidden_units])
+        k, v = F.linear(key_value, layer.in_proj_weight[hidden_units:],
+                        layer.in_proj_bias[hidden_units:]).chunk(2, dim=-1)
+        # [batch_size, num_heads, seq_len, head_dim]
+        q, k, v = (x.view(batch_size, seq_len, self.num_heads, head_dim).transpose(1, 2) for x in (q, k, v))
+
+        outputs = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attention_mask,
+            dropout_p=layer.dropout if self.training else 0.0, is_causal=attention_mask is None
+        )
+        outputs = outputs.transpose(1, 2).reshape(batch_size, seq_len, hidden_units)
+        return layer.out_proj(outputs)
+
+    def output_embeddings(self):
+        """Веса и смещение выходной проекции (item_emb разделяется со входом): ([item_num + 1, hidden], None)."""
+        return self.item_emb.weight, None
+
+    def score_hidden(self, hidden):
+        """Применяет выходную голову к скрытым состояниям [..., hidden_units] => [..., item_num + 1]."""
+        return torch.matmul(hidden, self.item_emb.weight.transpose(0, 1))
+
+    def forward(self, input_ids, user_profile_emb=None, apply_head=True):
+        """
+        apply_head=False возвращает скрытые состояния вместо логитов (для сэмплированных лоссов).
+        """
+        outputs = self.log2feats(input_ids, user_profile_emb)
         reconstruction_input = mean_weightening(outputs)
 
-        if self.add_head:
-            outputs = torch.matmul(
-                outputs, self.item_emb.weight.transpose(0, 1)
-            )
+        if self.add_head and apply_head:
+            outputs = self.score_hidden(outputs)
 
         return outputs, reconstruction_input
 
+    def predict_next(self, input_ids, user_profile_emb=None, apply_head=True):
+        """
+        Инференс: скоры товаров только для последней позиции последовательности.
+
+        В отличие от forward, на item_emb.weight умножается одно скрытое состояние на пример,
+        поэтому тензор [batch_size, seq_len, item_num + 1] не материализуется.
+
+        apply_head=False возвращает скрытое состояние (для поблочного скоринга каталога).
+
+        Возвращает: [batch_size, item_num + 1] (или [batch_size, hidden_units] без головы)
+        """
+        last_hidden = self.log2feats(input_ids, user_profile_emb)[:, -1, :]  # [batch_size, hidden_units]
+
+        if self.add_head and apply_head:
+            return self.score_hidden(last_hidden)
+        return last_hidden
+
     def aggregate_profile(self, user_profile_emb):
         """
         user_profile_emb: [batch_size, emb_dim]  или  [batch_size, K, emb_dim]
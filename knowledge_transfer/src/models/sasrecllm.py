@@ -92,7 +92,13 @@ class SASRecLLM(SASRec):
         aggregated = self.profile_aggregator(user_profile_emb, *self.multi_profile_weighting_kwargs)  # => [bsz, emb_dim_now])
         return aggregated
 
-    def forward(self, input_ids, return_hidden_states=False):
+    def forward(self, input_ids, user_profile_emb=None, return_hidden_states=False, apply_head=True,
+                compute_reconstruction=True):
+        """
+        user_profile_emb в прямом проходе не используется (профиль участвует только в guide-лоссе).
+        compute_reconstruction=False - облегчённый проход для фазы без guide-лосса: выход слоя reconstruction_layer
+        не сохраняется, reconstruction_input не считается (возвращается None).
+        """
         # 1) агрегируем профиль
         # user_profile_emb_agg = self.aggregate_profile(user_profile_emb)
 
@@ -100,45 +106,42 @@ class SASRecLLM(SASRec):
         seqs = self.item_emb(input_ids)
         seqs *= self.hidden_units ** 0.5
 
-        batch_size, seq_len = input_ids.size()
-        positions = torch.arange(seq_len, dtype=torch.long,
-                                 device=input_ids.device).unsqueeze(0).expand(batch_size, -1)
-        seqs += self.pos_emb(positions)
+        seqs += self.pos_emb(self.position_ids(input_ids))
         seqs = self.emb_dropout(seqs)
 
         timeline_mask = (input_ids == 0)
         seqs *= ~timeline_mask.unsqueeze(-1)
 
-        tl = seqs.shape[1]
-        attention_mask = ~torch.tril(
-            torch.ones((tl, tl), dtype=torch.bool, device=seqs.device)
-        )
+        attention_mask = self.causal_attention_mask(seqs, timeline_mask)
 
-        hidden_states = []
+        # Храним только выход слоя для reconstruction (без копии: следующие блоки его не меняют in-place);
+        # при reconstruction_layer == -1 используется выход last_layernorm
+        if compute_reconstruction and self.reconstruction_layer != -1:
+            reconstruction_index = range(len(self.attention_layers))[self.reconstruction_layer]
+        else:
+            reconstruction_index = None
+        reconstruction_hidden = None
 
         for i in range(len(self.attention_layers)):
-            seqs = seqs.transpose(0, 1)
-            Q = self.attention_layernorms[i](seqs)
-            mha_outputs, _ = self.attention_layers[i](
-                Q, seqs, seqs, attn_mask=attention_mask
-            )
-            seqs = Q + mha_outputs
-            seqs = seqs.transpose(0, 1)
+            seqs = self.self_attention(i, seqs, attention_mask)
             seqs = self.forward_layernorms[i](seqs)
             seqs = self.forward_layers[i](seqs)
             seqs *= ~timeline_mask.unsqueeze(-1)
-            hidden_states.append(seqs.clone())
+            if i == reconstruction_index:
+                reconstruction_hidden = seqs
 
         outputs = self.last_layernorm(seqs)
 
         # 3) Reconstruction layer:
-        if self.reconstruction_layer == -1:
+        if not compute_reconstruction:
+            reconstruction_input = None
+        elif self.reconstruction_layer == -1:
             reconstruction_input = self.weighting_fn(outputs, **self.weighting_kwargs)  # [batch_size, hidden_units]
         else:
-            reconstruction_input = self.weighting_fn(hidden_states[self.reconstruction_layer], **self.weighting_kwargs)  # [batch_size, hidden_units]
+            reconstruction_input = self.weighting_fn(reconstruction_hidden, **self.weighting_kwargs)  # [batch_size, hidden_units]
 
-        # 4) add_head => logits
-        if self.add_head:
-            outputs = torch.matmul(outputs, self.item_emb.weight.transpose(0, 1))
+        # 4) add_head => logits (apply_head=False оставляет скрытые состояния для сэмплированных лоссов)
+        if self.add_head and apply_head:
+            outputs = self.score_hidden(outputs)
 
         return outputs, reconstruction_input
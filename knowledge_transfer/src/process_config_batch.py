@@ -1,10 +1,16 @@
 import os
+import json
+import time
+import queue
 import argparse
+import resource
+import traceback
+import multiprocessing as mp
 
-from src.training import process_config
+import yaml
 
 
-def process_files_in_range(folder_path, start, end):
+def select_config_files(folder_path, start, end):
     # List all files in the directory
     files = os.listdir(folder_path)
 
@@ -19,15 +25,165 @@ def process_files_in_range(folder_path, start, end):
     else:
         files_to_process = files[start:end]
 
-    # Process each file in the range
+    config_files = []
     for file in files_to_process:
         file_path = os.path.join(folder_path, file)
 
         if os.path.isfile(file_path):  # Check if it's a file
-            print(f"Processing file: {file_path}")
-            process_config(file_path)
+            config_files.append(file_path)
         else:
             print(f"Skipping non-file: {file_path}")
+    return config_files
+
+
+def is_completed(config):
+    """
+    Конфиг уже посчитан, если есть итоговая модель {model_dir}/{model_name}_model.pt
+    и завершённый MLflow-ран с именем experiment_name.
+    """
+    model_path = os.path.join(config['training']['model_dir'], f"{config['model']['model_name']}_model.pt")
+    if not os.path.exists(model_path):
+        return False
+
+    import mlflow
+    client = mlflow.MlflowClient()
+    experiment_ids = [experiment.experiment_id for experiment in client.search_experiments()]
+    if not experiment_ids:
+        return False
+    run_name = config['experiment_name'].replace("'", "\\'")
+    runs = client.search_runs(
+        experiment_ids,
+        filter_string=f"attributes.run_name = '{run_name}' and attributes.status = 'FINISHED'",
+        max_results=1,
+    )
+    return len(runs) > 0
+
+
+def _peak_rss_mb():
+    """Пиковый RSS процесса и его дочерних процессов (распределённое обучение), МБ."""
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak_kb / 1024
+
+
+def _run_job(job):
+    """Обучение по одному конфигу в отдельном процессе; ошибки не прерывают остальной перебор."""
+    config_file, threads = job
+    # Ограничиваем потоки до импорта torch, чтобы задачи пула не конкурировали за ядра
+    for env_var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[env_var] = str(threads)
+
+    import torch
+    from src.training import process_config
+    torch.set_num_threads(threads)
+
+    start_time = time.time()
+    result = {'config': config_file, 'status': 'done', 'error': None}
+    try:
+        process_config(config_file)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['wall_time_s'] = round(time.time() - start_time, 2)
+    result['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+    return result
+
+
+def _job_process(job_id, job, result_queue):
+    result_queue.put((job_id, _run_job(job)))
+
+
+def run_sweep(config_files, num_workers=1, threads_per_job=None, resume=True, report_path=None):
+    """
+    Запускает обучение по списку конфигов в пуле из num_workers процессов.
+
+    Каждая задача идёт в новом недемоническом процессе, поэтому пиковый RSS относится к одной задаче,
+    память освобождается между задачами, а сама задача может запускать свои процессы (воркеры DataLoader,
+    распределённое обучение). threads_per_job - число потоков torch/OpenMP на задачу
+    (по умолчанию ядра делятся поровну). При resume уже посчитанные конфиги (см. is_completed) пропускаются.
+    Результаты (статус, время, пиковый RSS) дописываются в report_path (JSON lines) по мере завершения.
+    """
+    if threads_per_job is None:
+        threads_per_job = max(1, (os.cpu_count() or 1) // num_workers)
+
+    results = []
+    skipped = []
+    jobs = []
+    for config_file in config_files:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+        if resume and is_completed(config):
+            skipped.append({'config': config_file, 'status': 'skipped', 'error': None,
+                            'wall_time_s': 0.0, 'peak_rss_mb': None})
+            continue
+        jobs.append((config_file, threads_per_job))
+
+    def record(result):
+        results.append(result)
+        print(f"[{result['status']}] {result['config']} | wall time {result['wall_time_s']} s "
+              f"| peak RSS {result['peak_rss_mb']} MB")
+        if result['error'] is not None:
+            print(result['error'])
+        if report_path is not None:
+            with open(report_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + '\n')
+
+    for result in skipped:
+        record(result)
+
+    # Не Pool: его процессы демонические и не могут запускать дочерние процессы.
+    # spawn: задачи не наследуют состояние torch/MLflow родителя
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    pending = list(enumerate(jobs))
+    running = {}
+
+    def finish(job_id, result):
+        # Задача уже учтена как упавшая - повторный результат не записываем
+        entry = running.pop(job_id, None)
+        if entry is None:
+            return
+        entry[1].join()
+        record(result)
+
+    while pending or running:
+        while pending and len(running) < num_workers:
+            job_id, job = pending.pop(0)
+            process = ctx.Process(target=_job_process, args=(job_id, job, result_queue))
+            process.start()
+            running[job_id] = (job, process)
+
+        try:
+            job_id, result = result_queue.get(timeout=1)
+        except queue.Empty:
+            dead = [job_id for job_id, (job, process) in running.items()
+                    if not process.is_alive() and process.exitcode != 0]
+            # Процесс мог отдать результат и упасть уже после _run_job (например, при завершении интерпретатора):
+            # сначала разбираем очередь, упавшими считаются только задачи без результата
+            while dead:
+                try:
+                    job_id, result = result_queue.get_nowait()
+                except queue.Empty:
+                    break
+                finish(job_id, result)
+            for job_id in dead:
+                if job_id in running:
+                    job, process = running.pop(job_id)
+                    process.join()
+                    record({'config': job[0], 'status': 'failed',
+                            'error': f'Job process exited with code {process.exitcode}',
+                            'wall_time_s': None, 'peak_rss_mb': None})
+            continue
+        finish(job_id, result)
+    return results
+
+
+def process_files_in_range(folder_path, start, end, num_workers=1, threads_per_job=None, resume=True,
+                           report_path=None):
+    config_files = select_config_files(folder_path, start, end)
+    print(f"Processing {len(config_files)} configs with {num_workers} workers")
+    return run_sweep(config_files, num_workers=num_workers, threads_per_job=threads_per_job,
+                     resume=resume, report_path=report_path)
 
 
 if __name__ == "__main__":
@@ -36,12 +192,21 @@ if __name__ == "__main__":
     parser.add_argument("--folder_path", type=str, help="Path to the folder containing the files.")
     parser.add_argument("--start", type=int, help="Starting index (inclusive).")
     parser.add_argument("--end", type=int, help="Ending index (exclusive).")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of configs trained in parallel.")
+    parser.add_argument("--threads_per_job", type=int, default=None,
+                        help="CPU threads per job (defaults to CPU cores divided by num_workers).")
+    parser.add_argument("--no_resume", action="store_true",
+                        help="Also rerun configs whose final model and finished MLflow run already exist.")
+    parser.add_argument("--report_path", type=str, default=None,
+                        help="JSON lines file for per-job status, wall time and peak RSS.")
 
     # Parse arguments
     args = parser.parse_args()
 
     # Call the function with parsed arguments
-    process_files_in_range(args.folder_path, args.start, args.end)
+    process_files_in_range(args.folder_path, args.start, args.end, num_workers=args.num_workers,
+                           threads_per_job=args.threads_per_job, resume=not args.no_resume,
+                           report_path=args.report_path)
 
 
-# process_files_in_range('experiments/configs/final_sasrec_exps/kion_en', None, 3)
\ No newline at end of file
+# process_files_in_range('experiments/configs/final_sasrec_exps/kion_en', None, 3)
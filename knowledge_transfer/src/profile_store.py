@@ -0,0 +1,137 @@
+# src/profile_store.py
+
+import torch
+
+
+PROFILE_STORAGE_DTYPES = ['fp32', 'fp16', 'int8']
+
+
+class ProfileEmbeddingStore:
+    """
+    Таблица эмбеддингов профилей пользователей [num_users, emb_dim] или [num_users, K, emb_dim]
+    с маской отсутствующих профилей [num_users].
+
+    Таблица может лежать на устройстве (как раньше) или в памяти хоста; во втором случае на устройство
+    переносятся только строки батча. Для экономии памяти строки можно хранить в fp16 или в int8
+    с масштабом на строку; деквантизация выполняется уже на устройстве, поэтому модель
+    (`aggregate_profile`) всегда получает float32.
+
+    Если параметры агрегации профиля не меняются, `project(model)` заранее применяет `model.aggregate_profile`
+    ко всей таблице; такая таблица (`projected=True`) хранит уже готовые [num_users, hidden_units]
+    с тем же типом хранения и размещением, что и исходная.
+    """
+
+    def __init__(self, embeddings, null_profile_binary_mask, device, storage_dtype='fp32',
+                 on_device=True, pin_memory=False, projected=False):
+        if storage_dtype not in PROFILE_STORAGE_DTYPES:
+            raise ValueError(f'Unknown profile storage dtype: {storage_dtype}')
+
+        self.device = device
+        self.storage_dtype = storage_dtype
+        self.on_device = on_device
+        self.pin_memory = pin_memory
+        self.projected = projected
+        self.emb_dim = embeddings.size(-1)
+        self.scales = None
+
+        if storage_dtype == 'fp16':
+            table = embeddings.half()
+        elif storage_dtype == 'int8':
+            # Симметричное квантование с масштабом на строку (на каждый профиль)
+            scales = embeddings.abs().amax(dim=-1, keepdim=True).clamp(min=1e-12) / 127
+            table = torch.round(embeddings / scales).clamp(-127, 127).to(torch.int8)
+            self.scales = scales.float()
+        else:
+            table = embeddings.float()
+
+        storage_device = device if on_device else torch.device('cpu')
+        self.table = table.to(storage_device)
+        self.null_profile_binary_mask = null_profile_binary_mask.to(storage_device)
+        if self.scales is not None:
+            self.scales = self.scales.to(storage_device)
+
+        # Строки батча копируются в закреплённую память, чтобы перенос на GPU был асинхронным
+        self.non_blocking = (not on_device) and pin_memory and device.type == 'cuda'
+        # Последняя проекция и версии параметров агрегации, по которым она посчитана
+        self.projection = None
+        self.projection_key = None
+
+    def __len__(self):
+        return self.table.size(0)
+
+    def gather(self, user_ids):
+        """
+        Возвращает эмбеддинги профилей [batch_size, (K,) emb_dim] (float32) и маску
+        отсутствующих профилей [batch_size] для user_ids на self.device.
+        """
+        user_ids = user_ids.to(self.table.device)
+
+        rows = self.table.index_select(0, user_ids)
+        mask = self.null_profile_binary_mask.index_select(0, user_ids)
+        scales = self.scales.index_select(0, user_ids) if self.scales is not None else None
+        if self.non_blocking:
+            rows, mask = rows.pin_memory(), mask.pin_memory()
+            scales = scales.pin_memory() if scales is not None else None
+
+        # Переносим компактное представление и деквантизуем уже на устройстве
+        rows = rows.to(self.device, non_blocking=self.non_blocking).float()
+        mask = mask.to(self.device, non_blocking=self.non_blocking)
+        if scales is not None:
+            rows = rows * scales.to(self.device, non_blocking=self.non_blocking)
+        return rows, mask
+
+    @torch.no_grad()
+    def project(self, model, batch_size=4096):
+        """
+        Таблица агрегированных профилей `model.aggregate_profile` по всем пользователям [num_users, hidden_units].
+        Считается батчами по batch_size пользователей; после этого шаг обучения или оценки сводится к индексации
+        таблицы вместо проекции сырых профилей каждого батча.
+
+        Без параметров агрегации проекция ничего не экономит, и возвращается сама таблица (projected=False).
+        Результат кэшируется, пока не изменятся параметры агрегации (счётчики версий тензоров растут при
+        шаге оптимизатора и load_state_dict), поэтому повторные оценки с замороженной агрегацией его переиспользуют.
+        """
+        params = profile_aggregation_parameters(model)
+        if not params:
+            return self
+        key = tuple((id(param), param._version) for param in params)
+        if self.projection is not None and self.projection_key == key:
+            return self.projection
+
+        # Устаревшая проекция освобождается до подсчёта новой. Готовые строки сразу уходят туда, где хранится
+        # таблица: при on_device=False на устройстве не собирается плотная таблица
+        self.projection = None
+        storage_device = self.device if self.on_device else torch.device('cpu')
+        chunks = []
+        for start in range(0, len(self), batch_size):
+            user_ids = torch.arange(start, min(start + batch_size, len(self)))
+            rows, _ = self.gather(user_ids)
+            chunks.append(model.aggregate_profile(rows).float().to(storage_device))
+
+        self.projection = ProfileEmbeddingStore(torch.cat(chunks), self.null_profile_binary_mask, self.device,
+                                                storage_dtype=self.storage_dtype, on_device=self.on_device,
+                                                pin_memory=self.pin_memory, projected=True)
+        self.projection_key = key
+        return self.projection
+
+
+def profile_aggregation_parameters(model):
+    """
+    Параметры, которые использует `model.aggregate_profile`: проекция profile_transform (при use_down_scale)
+    и агрегатор нескольких профилей, если это модуль (attention). Базовый SASRec создаёт profile_transform
+    и без use_down_scale, поэтому отбор по именам параметров здесь не подходит.
+    """
+    params = []
+    if getattr(model, 'use_down_scale', False):
+        params += list(model.profile_transform.parameters())
+    if isinstance(getattr(model, 'profile_aggregator', None), torch.nn.Module):
+        params += list(model.profile_aggregator.parameters())
+    return params
+
+
+def profile_aggregation_frozen(model):
+    """
+    True, если `model.aggregate_profile` не обучается: у проекции и агрегатора профилей нет параметров
+    с requires_grad (в том числе когда агрегация вовсе без параметров).
+    """
+    return all(not param.requires_grad for param in profile_aggregation_parameters(model))
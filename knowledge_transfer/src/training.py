@@ -8,47 +8,63 @@ import pickle
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 
 from src.models.bert4rec import BERT4Rec
 from src.models.bert4recllm import BERT4RecLLM
 from src.models.sasrec import SASRec
 from src.models.sasrecllm import SASRecLLM
-from src.utils import set_seed, load_user_profile_embeddings, init_criterion_reconstruct, \
-    load_user_profile_embeddings_any, calculate_recsys_loss, calculate_guide_loss
-from src.dataset import SequenceDataset, BERT4RecDataset
+from src.utils import set_seed, init_criterion_reconstruct, calculate_recsys_loss, calculate_guide_loss, \
+    get_autocast, get_grad_scaler, seed_worker
+from src.dataset import SequenceDataset, BERT4RecDataset, collate_pretensorized, collate_trimmed, \
+    LengthBucketBatchSampler
 from src.evaluation import evaluate_model, evaluate_bert4rec_model
+from src.losses import init_criterion_recsys, SampledRecsysLoss
+from src.profile_store import ProfileEmbeddingStore, profile_aggregation_frozen
+from src.distributed import launch_distributed, broadcast_parameters, sync_gradients, all_reduce_sum
+from src.data_cache import get_padded_cache_path, load_sequences, load_profile_table, load_history_index, \
+    load_negative_candidates
+from src.history_index import SeenItemIndex
+from src.early_stopping import EarlyStopping
+from src.checkpoint import AsyncCheckpointWriter, get_rng_state, set_rng_state
 import mlflow
 from tqdm import tqdm
 
-# Активируем обнаружение аномалий в PyTorch
-torch.autograd.set_detect_anomaly(True)
 
-def train_model(config):
+def train_model(config, rank=0, world_size=1):
+    """
+    Обучает модель по конфигу. rank/world_size задаются launch_distributed при распределённом обучении:
+    каждый процесс обучается на своей части пользователей, градиенты и метрики усредняются по процессам,
+    а MLflow и сохранение модели выполняются только в процессе 0.
+    """
+    is_main_process = rank == 0
     # Установка зерна для воспроизводимости
     set_seed(config['seed'])
 
-    # Загрузка обработанных данных
-    with open(config['data']['profile_train_sequences'], 'rb') as f:
-        profile_train_sequences = pickle.load(f)
-    with open(config['data']['valid_sequences'], 'rb') as f:
-        valid_sequences = pickle.load(f)
-    with open(config['data']['test_sequences'], 'rb') as f:
-        test_sequences = pickle.load(f)
-    with open(config['data']['mappings'], 'rb') as f:
-        mappings = pickle.load(f)
+    # Обнаружение аномалий в PyTorch сильно замедляет backward, поэтому включается только для отладки
+    torch.autograd.set_detect_anomaly(config['training'].get('detect_anomaly', False))
+
+    # Загрузка обработанных данных: при включённом кэше (data.cache_dir) последовательности, уже
+    # сохранённые как паддингованные .npy, не распаковываются (load_sequences вернёт None)
+    profile_train_sequences = load_sequences(config, 'profile_train_sequences')
+    valid_sequences = load_sequences(config, 'valid_sequences')
+    test_sequences = load_sequences(config, 'test_sequences')
     with open(config['data']['counts'], 'rb') as f:
         counts = pickle.load(f)
 
-    user_id_mapping, item_id_mapping = mappings
     num_users, num_items = counts
     # Обновляем параметры модели
     config['model']['item_num'] = num_items
     config['model']['user_num'] = num_users
 
     # Определение устройства
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print('DEVICE:', device)
+    if world_size > 1:
+        # gloo - обучение на CPU, nccl - по GPU на процесс
+        backend = config['distributed'].get('backend', 'gloo')
+        device = torch.device(f'cuda:{rank}' if backend == 'nccl' else 'cpu')
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('DEVICE:', device, f'(rank {rank}/{world_size})' if world_size > 1 else '')
 
     # Получение имени модели из конфигурации
     model_name = config['model']['model_name']
@@ -57,47 +73,59 @@ def train_model(config):
     if model_name in ['SASRecLLM', 'BERT4RecLLM']:
         # Загружаем эмбеддинги профилей
         # Получаем Tensor [num_users, profile_emb_dim] ИЛИ [num_users, K, profile_emb_dim]
-        user_profile_embeddings, null_profile_binary_mask = load_user_profile_embeddings_any(config, user_id_mapping)
+        # С кэшем таблица открывается через memory-map, маппинги и JSON не читаются
+        user_profile_embeddings, null_profile_binary_mask = load_profile_table(config)
 
         profile_emb_dim = user_profile_embeddings.size(-1)
         assert profile_emb_dim != 2
 
-        # Перемещаем эмбеддинги профилей пользователей на устройство
-        user_profile_embeddings = user_profile_embeddings.to(device)
-        null_profile_binary_mask = null_profile_binary_mask.to(device)
+        # Таблица профилей целиком на устройстве (по умолчанию) или в памяти хоста с переносом строк батча;
+        # хранение в fp32, fp16 или int8 с масштабом на строку
+        profile_store = ProfileEmbeddingStore(
+            user_profile_embeddings,
+            null_profile_binary_mask,
+            device,
+            storage_dtype=config['data'].get('profile_storage_dtype', 'fp32'),
+            on_device=config['data'].get('profile_on_device', True),
+            pin_memory=config.get('dataloader', {}).get('pin_memory', False),
+        )
+        del user_profile_embeddings, null_profile_binary_mask
     else:
-        user_profile_embeddings = None
-        null_profile_binary_mask = None
+        profile_store = None
         profile_emb_dim = None
 
     # Создание датасетов в зависимости от модели
+    maxlen = config['model']['maxlen']
     if model_name in ['BERT4Rec', 'BERT4RecLLM']:
         # Для BERT4Rec используем специальный датасет с маскированием
         mask_token = num_items + 1  # Маска будет иметь ID, равный num_items + 1
 
         profile_train_dataset = BERT4RecDataset(
             profile_train_sequences,
-            config['model']['maxlen'],
+            maxlen,
             mask_token,
             num_items,
             mask_prob=config['training'].get('mask_prob', 0.15),
-            mode='train'
+            mode='train',
+            cache_path=get_padded_cache_path(config, 'profile_train_sequences')
         )
 
         valid_dataset = BERT4RecDataset(
             valid_sequences,
-            config['model']['maxlen'],
+            maxlen,
             mask_token,
             num_items,
-            mode='valid'
+            mode='valid',
+            cache_path=get_padded_cache_path(config, 'valid_sequences')
         )
 
         test_dataset = BERT4RecDataset(
             test_sequences,
-            config['model']['maxlen'],
+            maxlen,
             mask_token,
             num_items,
-            mode='test'
+            mode='test',
+            cache_path=get_padded_cache_path(config, 'test_sequences')
         )
 
         # Обновляем конфигурацию модели, чтобы учесть маскирующий токен
@@ -105,39 +133,51 @@ def train_model(config):
         config['model']['vocab_size'] = num_items + 2  # +1 для padding, +1 для mask
     else:
         # Для SASRec используем стандартный датасет
-        profile_train_dataset = SequenceDataset(profile_train_sequences, config['model']['maxlen'])
-        valid_dataset = SequenceDataset(valid_sequences, config['model']['maxlen'])
-        test_dataset = SequenceDataset(test_sequences, config['model']['maxlen'])
-
-    # Создание DataLoader
-    profile_train_loader = DataLoader(profile_train_dataset, batch_size=config['training']['batch_size'], shuffle=True)
+        profile_train_dataset = SequenceDataset(profile_train_sequences, maxlen,
+                                                cache_path=get_padded_cache_path(config, 'profile_train_sequences'))
+        valid_dataset = SequenceDataset(valid_sequences, maxlen,
+                                        cache_path=get_padded_cache_path(config, 'valid_sequences'))
+        test_dataset = SequenceDataset(test_sequences, maxlen,
+                                       cache_path=get_padded_cache_path(config, 'test_sequences'))
+
+    # Создание DataLoader (датасеты отдают батч целиком через __getitems__)
+    profile_train_loader = make_data_loader(profile_train_dataset, config, shuffle=True, rank=rank,
+                                            world_size=world_size)
     if config['data']['finetune_train_sequences'] == config['data']['profile_train_sequences']:
         finetune_train_dataset = profile_train_dataset
         finetune_train_loader = profile_train_loader
     else:
-        with open(config['data']['finetune_train_sequences'], 'rb') as f:
-            finetune_train_sequences = pickle.load(f)
-        finetune_train_dataset = SequenceDataset(finetune_train_sequences, config['model']['maxlen'])
-        finetune_train_loader = DataLoader(finetune_train_dataset, batch_size=config['training']['batch_size'], shuffle=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=config['training']['batch_size'], shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=config['training']['batch_size'], shuffle=False)
+        finetune_train_sequences = load_sequences(config, 'finetune_train_sequences')
+        finetune_train_dataset = SequenceDataset(finetune_train_sequences, maxlen,
+                                                 cache_path=get_padded_cache_path(config, 'finetune_train_sequences'))
+        finetune_train_loader = make_data_loader(finetune_train_dataset, config, shuffle=True, rank=rank,
+                                                 world_size=world_size)
+    valid_loader = make_data_loader(valid_dataset, config, shuffle=False, rank=rank, world_size=world_size)
+    test_loader = make_data_loader(test_dataset, config, shuffle=False, rank=rank, world_size=world_size)
+    # Асинхронный перенос батчей на устройство (имеет смысл вместе с pin_memory)
+    non_blocking = config.get('dataloader', {}).get('non_blocking', False)
 
     # Инициализация модели
     model = get_model(
         model_name, config, device,
         profile_emb_dim=profile_emb_dim
     )
+    if world_size > 1:
+        # Одинаковые начальные веса во всех процессах, но разные маски dropout
+        broadcast_parameters(model)
+        torch.manual_seed(config['seed'] + rank)
+
+    # torch.compile для прямого прохода и predict_next; state_dict остаётся без префиксов, чекпоинты совместимы
+    if config['training'].get('compile', False):
+        compile_model(model, mode=config['training'].get('compile_mode'))
 
 
     # Оптимизатор и функция потерь
     optimizer = torch.optim.AdamW(model.parameters(), lr=config['training']['learning_rate'])
-    # Выбор функции потерь в зависимости от модели
-    if model_name in ['BERT4Rec', 'BERT4RecLLM']:
-        # Для BERT4Rec игнорируем токены с target -100
-        criterion = nn.CrossEntropyLoss(ignore_index=-100)
-    else:
-        # Для SASRec игнорируем паддинги (0)
-        criterion = nn.CrossEntropyLoss(ignore_index=0)
+    # Полный softmax по каталогу (по умолчанию) или сэмплированный лосс из config['training']['recsys_loss']
+    criterion = init_criterion_recsys(config, model, profile_train_sequences)
+    # Сэмплированные лоссы работают со скрытыми состояниями, а не с логитами по всему каталогу
+    apply_head = not isinstance(criterion, SampledRecsysLoss)
 
     if model_name in ['SASRecLLM', 'BERT4RecLLM']:
         if 'reconstruct_loss' in config['training']:
@@ -152,25 +192,103 @@ def train_model(config):
     os.makedirs(model_dir, exist_ok=True)
 
     # Начало логирования с помощью MLflow
-    mlflow.start_run(run_name=config['experiment_name'])
-    mlflow.log_params(config['model'])
-    mlflow.log_params(config['training'])
+    if is_main_process:
+        mlflow.start_run(run_name=config['experiment_name'])
+        mlflow.log_params(config['model'])
+        mlflow.log_params(config['training'])
 
     # Параметры для комбинированной функции потерь
     alpha = config['training'].get('alpha', 0.5)
     fine_tune_epoch = config['training'].get('fine_tune_epoch', config['training']['epochs'] // 2)
     scale_guide_loss = config['training'].get('scale_guide_loss', False)
 
+    # Смешанная точность: fp32 (по умолчанию), bf16 или fp16 (с масштабированием градиентов)
+    precision = config['training'].get('precision', 'fp32')
+    scaler = get_grad_scaler(device, precision)
+    # Поблочный скоринг каталога при оценке (null - плотные логиты [batch_size, num_items])
+    eval_item_chunk_size = config['training'].get('eval_item_chunk_size')
+    # Фильтрация просмотренных товаров при оценке: CSR-индексы истории пользователей для валидации и теста
+    if config['training'].get('filter_seen_items', False):
+        valid_seen_items = SeenItemIndex(*load_history_index(config, 'valid_sequences', num_users), device)
+        test_seen_items = SeenItemIndex(*load_history_index(config, 'test_sequences', num_users), device)
+    else:
+        valid_seen_items = test_seen_items = None
+
+    # Протокол валидации: 'full' - ранжирование по всему каталогу, 'sampled' - цель против N негативов
+    # пользователя (сэмплируются один раз с фиксированным зерном и кэшируются). Тест всегда полный.
+    val_criterion = criterion
+    if config['training'].get('val_protocol', 'full') == 'sampled':
+        valid_negatives = torch.from_numpy(load_negative_candidates(
+            config, 'valid_sequences', num_users, num_items,
+            num_negatives=config['training'].get('val_num_negatives', 100),
+            sampling=config['training'].get('val_negative_sampling', 'uniform'),
+            seed=config['training'].get('val_negatives_seed', config['seed']),
+        )).to(device)
+        # Полный softmax-лосс скорит весь каталог по всем позициям - на сэмплированной валидации он не считается
+        if not isinstance(criterion, SampledRecsysLoss):
+            val_criterion = None
+    else:
+        valid_negatives = None
+
+    # Накопление градиентов: шаг оптимизатора раз в grad_accumulation_steps батчей; клиппинг по max_grad_norm
+    # (null - без клиппинга)
+    accumulation_steps = config['training'].get('grad_accumulation_steps', 1)
+    max_grad_norm = config['training'].get('max_grad_norm', 0.5)
+
+    # Чекпоинты эпох пишутся в фоновом потоке (AsyncCheckpointWriter) только процессом 0: последние
+    # keep_last_checkpoints (null - все) и лучшая эпоха; с checkpoint_optimizer в чекпоинт входят состояния
+    # оптимизатора, скейлера и генераторов случайных чисел для точного продолжения (training.resume_from)
     save_checkpoints = config['training'].get('save_checkpoints', False)
+    checkpoint_optimizer = config['training'].get('checkpoint_optimizer', False)
+    checkpoint_writer = AsyncCheckpointWriter(
+        keep_last=config['training'].get('keep_last_checkpoints')
+    ) if is_main_process else None
+    # Генераторы перемешивания обучающих загрузчиков (у DistributedSampler перемешивание зависит только от эпохи)
+    loader_generators = [loader.generator for loader in dict.fromkeys([profile_train_loader, finetune_train_loader])]
     eval_every = config['training'].get('eval_every', 1)
     epochs = config['training']['epochs']
+    # Тест на каждой валидации можно выключить: тогда тест считается один раз в конце
+    eval_test_every_epoch = config['training'].get('eval_test_every_epoch', True)
+
+    # Ранняя остановка и выбор лучшей эпохи по валидационной метрике (null - обучение на все epochs,
+    # в конце тестируется последняя эпоха)
+    early_stopping_metric = config['training'].get('early_stopping_metric')
+    if early_stopping_metric is not None:
+        early_stopping = EarlyStopping(
+            early_stopping_metric,
+            patience=config['training'].get('early_stopping_patience'),
+            min_delta=config['training'].get('early_stopping_min_delta', 0.0),
+            storage=config['training'].get('best_state_storage', 'memory'),
+            best_path=os.path.join(model_dir, f'{model_name}_best.pt'),
+            save_state=is_main_process,
+            writer=checkpoint_writer,
+        )
+    else:
+        early_stopping = None
 
     # делаем тренировочный - датасет с профилями
     train_loader = profile_train_loader
 
+    # Продолжение обучения с чекпоинта, сохранённого с checkpoint_optimizer: true
+    start_epoch = 1
+    resume_from = config['training'].get('resume_from')
+    if resume_from is not None:
+        checkpoint = torch.load(resume_from, map_location='cpu', weights_only=False)
+        if not isinstance(checkpoint, dict) or 'optimizer' not in checkpoint:
+            raise ValueError(f'{resume_from} has no optimizer state; save it with training.checkpoint_optimizer: true')
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        set_rng_state(checkpoint['rng'], loader_generators)
+        start_epoch = checkpoint['epoch'] + 1
+        if start_epoch >= fine_tune_epoch and model_name in ['SASRecLLM', 'BERT4RecLLM']:
+            train_loader = finetune_train_loader
+        print(f'Resumed from {resume_from} (epoch {checkpoint["epoch"]})')
+        del checkpoint
+
     evaluate_function = evaluate_bert4rec_model if model_name in ['BERT4Rec', 'BERT4RecLLM'] else evaluate_model
     # Цикл обучения
-    for epoch in range(1, epochs + 1):
+    for epoch in range(start_epoch, epochs + 1):
         start_time = time.time()
         model.train()
         total_loss = 0
@@ -178,91 +296,118 @@ def train_model(config):
         total_recsys_loss = 0
         # c = 0
 
+        # Новые маски BERT4Rec на каждой эпохе (воспроизводимо при любом числе воркеров)
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
+        # Разное перемешивание по эпохам для DistributedSampler
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+
+        # Guide-лосс входит в loss только до fine_tune_epoch; дальше LLM-модели идут облегчённым проходом
+        # (без скрытых состояний слоёв, reconstruction_input и выборки профилей)
+        guide_active = model_name in ['SASRecLLM', 'BERT4RecLLM'] and epoch < fine_tune_epoch
+        # Если параметры агрегации профиля заморожены, таблица агрегированных профилей считается один раз
+        # (project кэширует её, пока параметры не меняются; без параметров агрегации проекции нет)
+        train_profile_store = profile_store
+        if guide_active and profile_aggregation_frozen(model):
+            train_profile_store = profile_store.project(model)
+
         print('Len of train loader:', len(train_loader))
-        for batch in tqdm(train_loader):
+        optimizer.zero_grad()
+        for batch, recsys_weight, guide_weight, optimizer_step in iterate_with_accumulation(
+                tqdm(train_loader, disable=not is_main_process), accumulation_steps, criterion.ignore_index):
             if model_name in ['BERT4Rec', 'BERT4RecLLM']:
                 input_seq, target_seq, attention_mask, user_ids = batch
-                attention_mask = attention_mask.to(device)
+                attention_mask = attention_mask.to(device, non_blocking=non_blocking)
             else:
                 input_seq, target_seq, user_ids = batch
                 attention_mask = None
-            input_seq = input_seq.to(device)
-            target_seq = target_seq.to(device)
-            user_ids = user_ids.to(device)
-
-            if model_name in ['SASRecLLM', 'BERT4RecLLM']:
-                # Получаем эмбеддинги профиля пользователя, если они существуют
-                if user_profile_embeddings is not None:
-                    user_profile_emb = user_profile_embeddings[user_ids].to(device)
-                    null_profile_binary_mask_batch = null_profile_binary_mask[user_ids].flatten().to(device)
-                else:
-                    user_profile_emb = None
-                    null_profile_binary_mask_batch = None
-
-                # outputs, hidden_for_reconstruction = model(input_seq)
-                # Прямой проход с учетом типа модели
-                if model_name == 'BERT4RecLLM':
-                    outputs, hidden_for_reconstruction = model(
-                        input_seq,
-                        attention_mask=attention_mask,
-                        user_profile_emb=user_profile_emb
-                    )
-                else:
-                    outputs, hidden_for_reconstruction = model(
-                        input_seq,
-                        user_profile_emb=user_profile_emb
-                    )
-
-                # # Форматирование выходных данных и целей
-                # if model_name == 'BERT4RecLLM':
-                #     # Для BERT4Rec обрабатываем все токены
-                #     logits = outputs.view(-1, outputs.size(-1))
-                #     targets = target_seq.view(-1)
-                # else:
-                #     # Для SASRec обрабатываем только следующий токен
-                #     logits = outputs.view(-1, outputs.size(-1))
-                #     targets = target_seq.view(-1)
-
-
-                # лосс модели
-                loss_model = calculate_recsys_loss(target_seq, outputs, criterion)
-                loss_guide = calculate_guide_loss(model=model,
-                                                 user_profile_emb=user_profile_emb,
-                                                 hidden_for_reconstruction=hidden_for_reconstruction,
-                                                 null_profile_binary_mask_batch=null_profile_binary_mask_batch,
-                                                 criterion_reconstruct_fn=criterion_reconstruct_fn,)
-                if scale_guide_loss:
-                    loss_model_val = loss_model.item()
-                    loss_guide_val = loss_guide.item()
-                    eps = 1e-8
-
-                    scale_for_guide = loss_model_val / (loss_guide_val + eps)
-                    scaled_loss_guide = loss_guide * scale_for_guide
-                    # total_guide_loss += scaled_loss_guide.item()
-                    if epoch < fine_tune_epoch:
-                        loss = alpha * scaled_loss_guide + (1 - alpha) * loss_model
+            input_seq = input_seq.to(device, non_blocking=non_blocking)
+            target_seq = target_seq.to(device, non_blocking=non_blocking)
+            # user_ids остаются на хосте: по ним строки профилей выбираются там, где лежит таблица
+
+            # Прямой проход и лоссы под autocast (для fp32 контекст выключен)
+            with get_autocast(device, precision):
+                if guide_active:
+                    # Получаем эмбеддинги профиля пользователя, если они существуют
+                    if profile_store is not None:
+                        user_profile_emb, null_profile_binary_mask_batch = train_profile_store.gather(user_ids)
                     else:
-                        loss = loss_model
-                else:
-                    # Если scale_guide_loss=False, логика остаётся исходной
-                    if epoch < fine_tune_epoch:
-                        loss = alpha * loss_guide + (1 - alpha) * loss_model
+                        user_profile_emb = None
+                        null_profile_binary_mask_batch = None
+
+                    # outputs, hidden_for_reconstruction = model(input_seq)
+                    # Прямой проход с учетом типа модели
+                    if model_name == 'BERT4RecLLM':
+                        outputs, hidden_for_reconstruction = model(
+                            input_seq,
+                            attention_mask=attention_mask,
+                            user_profile_emb=user_profile_emb,
+                            apply_head=apply_head
+                        )
                     else:
-                        loss = loss_model
-
-                total_guide_loss += loss_guide.item()
-
-            else:
-                # Для SASRec получаем только outputs
-                outputs = model(input_seq)
-                loss_model = calculate_recsys_loss(target_seq, outputs, criterion)
-                loss = loss_model
-
-            # Шаги оптимизации
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=0.5)
-            optimizer.step()
+                        outputs, hidden_for_reconstruction = model(
+                            input_seq,
+                            user_profile_emb=user_profile_emb,
+                            apply_head=apply_head
+                        )
+
+                    # лосс модели
+                    loss_model = calculate_recsys_loss(target_seq, outputs, criterion)
+                    loss_guide = calculate_guide_loss(model=model,
+                                                     user_profile_emb=user_profile_emb,
+                                                     hidden_for_reconstruction=hidden_for_reconstruction,
+                                                     null_profile_binary_mask_batch=null_profile_binary_mask_batch,
+                                                     criterion_reconstruct_fn=criterion_reconstruct_fn,
+                                                     profile_projected=train_profile_store.projected)
+                    if scale_guide_loss:
+                        loss_model_val = loss_model.item()
+                        loss_guide_val = loss_guide.item()
+                        eps = 1e-8
+
+                        scale_for_guide = loss_model_val / (loss_guide_val + eps)
+                        scaled_loss_guide = loss_guide * scale_for_guide
+                        # total_guide_loss += scaled_loss_guide.item()
+                        guide_term = alpha * scaled_loss_guide
+                    else:
+                        # Если scale_guide_loss=False, логика остаётся исходной
+                        guide_term = alpha * loss_guide
+                    loss = guide_term + (1 - alpha) * loss_model
+                    # Вклад батча в шаг: лоссы нормируются на все цели и всех пользователей окна накопления
+                    step_loss = guide_term * guide_weight + (1 - alpha) * loss_model * recsys_weight
+
+                    total_guide_loss += loss_guide.item()
+
+                elif model_name == 'BERT4RecLLM':
+                    # Фаза дообучения: guide-лосс не нужен, reconstruction_input не считается
+                    outputs, _ = model(input_seq, attention_mask=attention_mask, apply_head=apply_head,
+                                       compute_reconstruction=False)
+                    loss_model = calculate_recsys_loss(target_seq, outputs, criterion)
+                    loss = loss_model
+                elif model_name == 'SASRecLLM':
+                    outputs, _ = model(input_seq, apply_head=apply_head, compute_reconstruction=False)
+                    loss_model = calculate_recsys_loss(target_seq, outputs, criterion)
+                    loss = loss_model
+                else:
+                    # Для SASRec получаем только outputs
+                    outputs = model(input_seq, apply_head=apply_head)
+                    loss_model = calculate_recsys_loss(target_seq, outputs, criterion)
+                    loss = loss_model
+
+            if not guide_active:
+                step_loss = loss_model * recsys_weight
+
+            # Шаги оптимизации (при fp16 лосс масштабируется, а градиенты возвращаются к исходному масштабу до клиппинга)
+            scaler.scale(step_loss).backward()
+            if optimizer_step:
+                # Усреднение градиентов по процессам (без распределённого режима ничего не делает)
+                sync_gradients(model)
+                scaler.unscale_(optimizer)
+                if max_grad_norm is not None:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
 
             total_loss += loss.item()
             total_recsys_loss += loss_model.item()
@@ -271,51 +416,94 @@ def train_model(config):
             # if c == 1:
             #     break
 
-        avg_loss = total_loss / len(train_loader)
-        avg_guide_loss = total_guide_loss / len(train_loader)
-        avg_recsys_loss = total_recsys_loss / len(train_loader)
-        print(f"Epoch: {epoch}/{config['training']['epochs']} | Train Total Loss: {avg_loss:.4f} "
-              f" | Recsys Total Loss | {avg_recsys_loss:.4f} | Guide Total Loss | {avg_guide_loss:.4f}")
-        print('Train Time taken (s):', time.time() - start_time)
+        # Средние по батчам всех процессов
+        loss_totals = all_reduce_sum(torch.tensor([total_loss, total_guide_loss, total_recsys_loss,
+                                                   float(len(train_loader))], dtype=torch.float64))
+        avg_loss, avg_guide_loss, avg_recsys_loss = (loss_totals[:3] / loss_totals[3]).tolist()
+        if is_main_process:
+            print(f"Epoch: {epoch}/{config['training']['epochs']} | Train Total Loss: {avg_loss:.4f} "
+                  f" | Recsys Total Loss | {avg_recsys_loss:.4f} | Guide Total Loss | {avg_guide_loss:.4f}")
+            print('Train Time taken (s):', time.time() - start_time)
 
-        # Сохраняем чекпоинт
-        if save_checkpoints:
-            checkpoint_path = os.path.join(model_dir, f'{model_name}_epoch_{epoch}.pt')
-            torch.save(model.state_dict(), checkpoint_path)
-            print(f"Checkpoint saved: {checkpoint_path}")
-
-        # Логирование метрик в MLflow
-        mlflow.log_metric('train_loss', avg_loss, step=epoch)
-        mlflow.log_metric('train_guide_loss', avg_guide_loss, step=epoch)
-        mlflow.log_metric('train_recsys_loss', avg_recsys_loss, step=epoch)
+            # Логирование метрик в MLflow
+            mlflow.log_metric('train_loss', avg_loss, step=epoch)
+            mlflow.log_metric('train_guide_loss', avg_guide_loss, step=epoch)
+            mlflow.log_metric('train_recsys_loss', avg_recsys_loss, step=epoch)
 
         # Оценка на валидационном наборе
-        if epoch % config['training']['eval_every'] == 0:
+        stop_training = False
+        is_best = False
+        if epoch % eval_every == 0:
             val_metrics = evaluate_function(model, valid_loader, device, mode='validation',
-                                         model_criterion=criterion, criterion_reconstruct_fn=criterion_reconstruct_fn,
-                                         user_profile_embeddings=user_profile_embeddings, null_profile_binary_mask=null_profile_binary_mask)
-            print(f"Validation Metrics: {val_metrics}")
-            # Логирование метрик с заменой недопустимых символов
-            for metric_name, metric_value in val_metrics.items():
-                sanitized_metric_name = metric_name.replace('@', '_')
-                mlflow.log_metric(f'val_{sanitized_metric_name}', metric_value, step=epoch)
+                                         model_criterion=val_criterion, criterion_reconstruct_fn=criterion_reconstruct_fn,
+                                         profile_store=profile_store,
+                                         precision=precision, non_blocking=non_blocking,
+                                         item_chunk_size=eval_item_chunk_size, seen_items=valid_seen_items,
+                                         negative_candidates=valid_negatives)
+            if is_main_process:
+                print(f"Validation Metrics: {val_metrics}")
+                # Логирование метрик с заменой недопустимых символов
+                for metric_name, metric_value in val_metrics.items():
+                    sanitized_metric_name = metric_name.replace('@', '_')
+                    mlflow.log_metric(f'val_{sanitized_metric_name}', metric_value, step=epoch)
+
+            if early_stopping is not None:
+                is_best = early_stopping.step(val_metrics, model, epoch)
+                if is_best and is_main_process:
+                    print(f"New best {early_stopping_metric}: {early_stopping.best_value:.6f} (epoch {epoch})")
+                stop_training = early_stopping.should_stop()
+
+        # Сохраняем чекпоинт (снимок на хост здесь, запись на диск - в фоне)
+        if save_checkpoints and is_main_process:
+            if checkpoint_optimizer:
+                checkpoint_state = {'epoch': epoch, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                                    'scaler': scaler.state_dict(), 'rng': get_rng_state(loader_generators)}
+            else:
+                checkpoint_state = model.state_dict()
+            checkpoint_path = os.path.join(model_dir, f'{model_name}_epoch_{epoch}.pt')
+            checkpoint_writer.save(checkpoint_state, checkpoint_path, is_best=is_best)
+            print(f"Checkpoint queued: {checkpoint_path}")
 
+        if epoch % eval_every == 0 and eval_test_every_epoch:
             start_time = time.time()
-            test_metrics = evaluate_function(model, test_loader, device, mode='test')
-            print(f"Test Metrics: {test_metrics}")
-            print('Test Time taken (s):', time.time() - start_time)
-            # Логирование метрик с заменой недопустимых символов
-            for metric_name, metric_value in test_metrics.items():
-                sanitized_metric_name = metric_name.replace('@', '_')
-                mlflow.log_metric(f'test_{sanitized_metric_name}', metric_value, step=epoch)
+            test_metrics = evaluate_function(model, test_loader, device, mode='test', precision=precision,
+                                             non_blocking=non_blocking, item_chunk_size=eval_item_chunk_size,
+                                             seen_items=test_seen_items)
+            if is_main_process:
+                print(f"Test Metrics: {test_metrics}")
+                print('Test Time taken (s):', time.time() - start_time)
+                # Логирование метрик с заменой недопустимых символов
+                for metric_name, metric_value in test_metrics.items():
+                    sanitized_metric_name = metric_name.replace('@', '_')
+                    mlflow.log_metric(f'test_{sanitized_metric_name}', metric_value, step=epoch)
 
         # If it is the last epoch with profiles, we need to update the loader
         if (epoch == fine_tune_epoch - 1) and (model_name in ['SASRecLLM', 'BERT4RecLLM']):
             print('Changing loaders')
             train_loader = finetune_train_loader
 
+        if stop_training:
+            if is_main_process:
+                print(f"Early stopping at epoch {epoch}: no {early_stopping_metric} improvement "
+                      f"for {early_stopping.patience} evaluations")
+            break
+
+    # Итоговый тест и сохранение - для лучшей по валидации эпохи
+    if early_stopping is not None and early_stopping.best_epoch is not None:
+        early_stopping.restore(model)
+        broadcast_parameters(model)
+        if is_main_process:
+            print(f"Restored best epoch {early_stopping.best_epoch} "
+                  f"({early_stopping_metric} = {early_stopping.best_value:.6f})")
+            mlflow.log_metric('best_epoch', early_stopping.best_epoch)
+            mlflow.log_metric('stopped_epoch', epoch)
+
     # Оценка на тестовом наборе данных с использованием нового метода
-    test_metrics = evaluate_function(model, test_loader, device, mode='test')
+    test_metrics = evaluate_function(model, test_loader, device, mode='test', precision=precision,
+                                             non_blocking=non_blocking, item_chunk_size=eval_item_chunk_size,
+                                             seen_items=test_seen_items)
+    if not is_main_process:
+        return
     print(f"Test Metrics: {test_metrics}")
     # Логирование метрик с заменой недопустимых символов
     for metric_name, metric_value in test_metrics.items():
@@ -324,11 +512,95 @@ def train_model(config):
 
     # Сохранение модели
     model_save_path = os.path.join(model_dir, f'{model_name}_model.pt')
-    torch.save(model.state_dict(), model_save_path)
+    checkpoint_writer.submit(model.state_dict(), model_save_path)
+    checkpoint_writer.close()
     # mlflow.log_artifact(model_save_path, artifact_path=model_dir)
 
     mlflow.end_run()
 
+def iterate_with_accumulation(batches, accumulation_steps, ignore_index):
+    """
+    Группирует батчи в окна по accumulation_steps и отдаёт (batch, recsys_weight, guide_weight, optimizer_step).
+
+    recsys_weight - доля целей батча (target != ignore_index) среди целей окна, guide_weight - доля
+    пользователей батча. Лоссы батчей - средние, поэтому с такими весами сумма по окну равна лоссу одного
+    большого батча. optimizer_step=True у последнего батча окна (последнее окно эпохи может быть короче).
+    """
+    window = []
+    for batch in batches:
+        window.append(batch)
+        if len(window) == accumulation_steps:
+            yield from _weigh_accumulation_window(window, ignore_index)
+            window = []
+    if window:
+        yield from _weigh_accumulation_window(window, ignore_index)
+
+
+def _weigh_accumulation_window(window, ignore_index):
+    # Цели лежат на хосте, подсчёт не синхронизируется с устройством
+    num_targets = [int((batch[1] != ignore_index).sum()) for batch in window]
+    num_users = [batch[0].size(0) for batch in window]
+    total_targets = max(sum(num_targets), 1)
+    total_users = sum(num_users)
+    for i, batch in enumerate(window):
+        yield batch, num_targets[i] / total_targets, num_users[i] / total_users, i == len(window) - 1
+
+
+def make_data_loader(dataset, config, shuffle, rank=0, world_size=1):
+    """
+    DataLoader по секции config['dataloader']: num_workers, pin_memory, persistent_workers, prefetch_factor,
+    length_bucketing (батчи из последовательностей близкой длины, обрезанные по самой длинной; только SequenceDataset).
+    Порядок перемешивания и сиды воркеров выводятся из config['seed'], как и в set_seed.
+
+    При world_size > 1 каждый процесс получает свою часть: обучающие загрузчики - через DistributedSampler
+    (одинаковое число батчей во всех процессах), загрузчики оценки - каждый world_size-й пример без повторов.
+    """
+    loader_config = config.get('dataloader', {})
+    num_workers = loader_config.get('num_workers', 0)
+
+    generator = torch.Generator()
+    generator.manual_seed(config['seed'])
+
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = loader_config.get('persistent_workers', False)
+        kwargs['prefetch_factor'] = loader_config.get('prefetch_factor', 2)
+
+    if loader_config.get('length_bucketing', False):
+        if not isinstance(dataset, SequenceDataset):
+            raise ValueError('dataloader.length_bucketing is supported only for SASRec and SASRecLLM')
+        kwargs['batch_sampler'] = LengthBucketBatchSampler(
+            dataset.sequence_lengths(),
+            config['training']['batch_size'],
+            shuffle=shuffle,
+            generator=generator,
+            bucket_batches=loader_config.get('bucket_batches', 50),
+            num_replicas=world_size,
+            rank=rank,
+        )
+        collate_fn = collate_trimmed
+    else:
+        kwargs['batch_size'] = config['training']['batch_size']
+        if world_size > 1 and shuffle:
+            kwargs['sampler'] = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True,
+                                                   seed=config['seed'])
+        elif world_size > 1:
+            kwargs['sampler'] = range(rank, len(dataset), world_size)
+        else:
+            kwargs['shuffle'] = shuffle
+        collate_fn = collate_pretensorized
+
+    return DataLoader(
+        dataset,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        pin_memory=loader_config.get('pin_memory', False),
+        worker_init_fn=seed_worker,
+        generator=generator,
+        **kwargs
+    )
+
+
 def get_model(model_name, config, device, profile_emb_dim=None):
     if model_name == 'SASRecLLM':
         model = SASRecLLM(
@@ -345,6 +617,9 @@ def get_model(model_name, config, device, profile_emb_dim=None):
             dropout_rate=config['model']['dropout_rate'],
             initializer_range=config['model'].get('initializer_range', 0.02),
             add_head=config['model'].get('add_head', True),
+            attention_impl=config['model'].get('attention_impl', 'mha'),
+            mask_padding=config['model'].get('mask_padding',
+                                             config.get('dataloader', {}).get('length_bucketing', False)),
             reconstruction_layer=config['model'].get('reconstruction_layer', -1),
             multi_profile=config['model'].get('multi_profile', False),  # наш дополнительный флаг
             multi_profile_aggr_scheme=config['model']['multi_profile_aggr_scheme'],
@@ -359,6 +634,9 @@ def get_model(model_name, config, device, profile_emb_dim=None):
             dropout_rate=config['model']['dropout_rate'],
             initializer_range=config['model'].get('initializer_range', 0.02),
             add_head=config['model'].get('add_head', True),
+            attention_impl=config['model'].get('attention_impl', 'mha'),
+            mask_padding=config['model'].get('mask_padding',
+                                             config.get('dataloader', {}).get('length_bucketing', False)),
         ).to(device)
     elif model_name == 'BERT4Rec':
         model = BERT4Rec(
@@ -393,10 +671,24 @@ def get_model(model_name, config, device, profile_emb_dim=None):
     return model
 
 
+def compile_model(model, mode=None):
+    """
+    Компилирует model.forward и model.predict_next через torch.compile на месте.
+    В отличие от обёртки torch.compile(model), ключи state_dict не меняются.
+    """
+    model.compile(mode=mode)
+    model.predict_next = torch.compile(model.predict_next, mode=mode)
+    return model
+
+
 def process_config(config_file):
     with open(config_file, 'r', encoding='utf-8') as f:
         config = yaml.safe_load(f)
-    train_model(config)
+    # Секция distributed с world_size > 1 - обучение в нескольких процессах (см. launch_distributed)
+    if config.get('distributed', {}).get('world_size', 1) > 1:
+        launch_distributed(config, train_model)
+    else:
+        train_model(config)
 
 
 if __name__ == '__main__':
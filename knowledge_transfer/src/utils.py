@@ -1,5 +1,6 @@
 # src/utils.py
 
+import os
 import random
 import numpy as np
 import torch
@@ -16,67 +17,125 @@ def set_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
-def load_user_profile_embeddings(file_path, user_id_mapping):
+def seed_worker(worker_id):
     """
-    Старый метод: загружает эмбеддинги профилей пользователей из ОДНОГО JSON-файла,
-    результат: [num_users, emb_dim], [num_users]
+    worker_init_fn для DataLoader: сидирует random/numpy воркера от torch-сида,
+    который DataLoader выводит из своего генератора (см. set_seed).
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+
+
+PRECISION_DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_autocast(device, precision='fp32'):
+    """
+    Контекст autocast для заданной точности: 'fp32' (autocast выключен), 'bf16' или 'fp16'.
+    """
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f'Unknown precision: {precision}')
+    return torch.autocast(device_type=device.type, dtype=PRECISION_DTYPES[precision],
+                          enabled=precision != 'fp32')
+
+
+def get_grad_scaler(device, precision='fp32'):
+    """GradScaler нужен только для fp16; для fp32/bf16 возвращается выключенный (прозрачный) скейлер."""
+    return torch.cuda.amp.GradScaler(enabled=(precision == 'fp16' and device.type == 'cuda'))
+
+
+def get_embeddings_ids_path(npy_path):
+    """Путь к индексу id пользователей для бинарного файла эмбеддингов: <name>.npy => <name>.ids.json."""
+    return os.path.splitext(npy_path)[0] + '.ids.json'
+
+
+def save_profile_embeddings_npy(user_ids, embeddings, npy_path):
+    """
+    Сохраняет эмбеддинги профилей в бинарном формате:
+    <name>.npy - float32 [num_users, emb_dim], <name>.ids.json - список id пользователей в порядке строк.
+    """
+    np.save(npy_path, np.asarray(embeddings, dtype=np.float32))
+    with open(get_embeddings_ids_path(npy_path), 'w') as f:
+        json.dump([str(user_id) for user_id in user_ids], f)
+
+
+def read_profile_embeddings(file_path):
+    """
+    Читает файл эмбеддингов профилей: бинарный .npy (memory-map) или JSON {user_id: [..]}.
+    Возвращает: (список id пользователей, np.ndarray [num_users, emb_dim]).
     """
+    if file_path.endswith('.npy'):
+        with open(get_embeddings_ids_path(file_path), 'r') as f:
+            user_ids = json.load(f)
+        return user_ids, np.load(file_path, mmap_mode='r')
+
     with open(file_path, 'r') as f:
         user_profiles_data = json.load(f)
+    return list(user_profiles_data.keys()), np.array(list(user_profiles_data.values()), dtype=np.float32)
+
+
+def _gather_profile_table(file_path, user_id_mapping, num_rows):
+    """
+    Раскладывает эмбеддинги из файла по индексам user_id_mapping одним fancy-index.
+    Возвращает: np.ndarray [num_rows, emb_dim] (нули для отсутствующих профилей) и список индексов без профиля.
+    """
+    user_ids, embeddings = read_profile_embeddings(file_path)
+    row_by_user = {user_id: row for row, user_id in enumerate(user_ids)}
+
+    dst_rows, src_rows, missing = [], [], []
+    for original_id, idx in user_id_mapping.items():
+        row = row_by_user.get(str(original_id))
+        if row is not None:
+            dst_rows.append(idx)
+            src_rows.append(row)
+        else:
+            missing.append(idx)
+
+    table = np.zeros((num_rows, embeddings.shape[1]), dtype=np.float32)
+    if dst_rows:
+        # Сортировка строк-источников делает чтение memory-map последовательным
+        order = np.argsort(src_rows)
+        table[np.asarray(dst_rows)[order]] = embeddings[np.asarray(src_rows)[order]]
+    return table, missing
+
 
-    embedding_dim = len(next(iter(user_profiles_data.values())))
+def load_user_profile_embeddings(file_path, user_id_mapping):
+    """
+    Старый метод: загружает эмбеддинги профилей пользователей из ОДНОГО файла (JSON или .npy),
+    результат: [num_users, emb_dim], [num_users]
+    """
     # num_users = len(user_id_mapping)
     max_idx = max(user_id_mapping.values()) + 1  # Ensure list can accommodate the highest index
     print('Seq Stats:', max_idx, len(user_id_mapping))
-    user_profiles_list = [[0.0] * embedding_dim for _ in range(max_idx)]
-    null_profile_binary_mask = [False for _ in range(max_idx)]
 
-    not_found_profiles_cnt = 0
-    for original_id, idx in user_id_mapping.items():
-        embedding = user_profiles_data.get(str(original_id))
-        if embedding is not None:
-            user_profiles_list[idx] = embedding
-        else:
-            # Если эмбеддинг не найден, инициализируем нулями
-            # user_profiles_list[idx] = [0.0] * embedding_dim
-            null_profile_binary_mask[idx] = True
-    print(f"Number of users without profiles: {not_found_profiles_cnt}")
+    # Если эмбеддинг не найден, строка остаётся нулевой и помечается в маске
+    user_profiles, missing = _gather_profile_table(file_path, user_id_mapping, max_idx)
+    null_profile_binary_mask = np.zeros(max_idx, dtype=bool)
+    null_profile_binary_mask[missing] = True
+    print(f"Number of users without profiles: {len(missing)}")
 
-    user_profiles_tensor = torch.tensor(user_profiles_list, dtype=torch.float)
-    null_profile_binary_mask_tensor = torch.BoolTensor(null_profile_binary_mask)
+    user_profiles_tensor = torch.from_numpy(user_profiles)
+    null_profile_binary_mask_tensor = torch.from_numpy(null_profile_binary_mask)
     return user_profiles_tensor, null_profile_binary_mask_tensor
 
 
 def load_user_profiles_multi(files_list, user_id_mapping):
     """
-    Новый метод: загружает несколько JSON-файлов => [num_users, K, emb_dim], [num_users, K]
+    Новый метод: загружает несколько файлов (JSON или .npy) => [num_users, K, emb_dim], [num_users, K]
     """
     all_tensors = []
     all_masks = []
 
     for file_path in files_list:
-        with open(file_path, 'r') as f:
-            user_profiles_data = json.load(f)
-
-        embedding_dim = len(next(iter(user_profiles_data.values())))
         num_users = len(user_id_mapping)
 
-        user_profiles_list = [None] * num_users
-        null_profile_binary_mask = [False] * num_users
-
-        for original_id, idx in user_id_mapping.items():
-            emb = user_profiles_data.get(str(original_id))
-            if emb is not None:
-                user_profiles_list[idx] = emb
-            else:
-                user_profiles_list[idx] = [0.0] * embedding_dim
-                null_profile_binary_mask[idx] = True
-
-        user_profiles_tensor = torch.tensor(user_profiles_list, dtype=torch.float32)
-        null_mask_tensor = torch.tensor(null_profile_binary_mask, dtype=torch.bool)
+        user_profiles, missing = _gather_profile_table(file_path, user_id_mapping, num_users)
+        null_profile_binary_mask = np.zeros(num_users, dtype=bool)
+        null_profile_binary_mask[missing] = True
 
-        all_tensors.append(user_profiles_tensor)
-        all_masks.append(null_mask_tensor)
+        all_tensors.append(torch.from_numpy(user_profiles))
+        all_masks.append(torch.from_numpy(null_profile_binary_mask))
 
     # stack => [num_users, K, emb_dim], [num_users, K]
     user_profiles_tensor_3d = torch.stack(all_tensors, dim=1)
@@ -140,7 +199,8 @@ def calculate_guide_loss(model,
                          user_profile_emb,
                          hidden_for_reconstruction,
                          null_profile_binary_mask_batch,
-                         criterion_reconstruct_fn):
+                         criterion_reconstruct_fn,
+                         profile_projected=False):
     # if model.use_down_scale:
     #     user_profile_emb_transformed = model.profile_transform(user_profile_emb)
     # else:
@@ -154,15 +214,20 @@ def calculate_guide_loss(model,
     # return loss_guide
 
     # pass
-    user_profile_emb_transformed = model.aggregate_profile(user_profile_emb)
+    # profile_projected: строки уже взяты из таблицы ProfileEmbeddingStore.project (свежий тензор после gather)
+    if profile_projected:
+        user_profile_emb_transformed = user_profile_emb
+    else:
+        user_profile_emb_transformed = model.aggregate_profile(user_profile_emb)
     try:
         if model.use_upscale:
             hidden_for_reconstruction = model.hidden_layer_transform(hidden_for_reconstruction)
     except:
         pass
 
+    # При autocast профиль и скрытые состояния могут оказаться в разных dtype
     user_profile_emb_transformed[null_profile_binary_mask_batch] = \
-        hidden_for_reconstruction[null_profile_binary_mask_batch]
+        hidden_for_reconstruction[null_profile_binary_mask_batch].to(user_profile_emb_transformed.dtype)
 
     loss_guide = criterion_reconstruct_fn(hidden_for_reconstruction, user_profile_emb_transformed)
     return loss_guide
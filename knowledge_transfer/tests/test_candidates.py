@@ -0,0 +1,44 @@
+import numpy as np
+
+from src.candidates import sample_negative_candidates
+
+
+def _sequences(num_users=30, num_items=100, seed=0):
+    rng = np.random.default_rng(seed)
+    return {user_id: rng.integers(1, num_items + 1, rng.integers(2, 40)).tolist() for user_id in range(num_users)}
+
+
+def test_negatives_exclude_history_and_target():
+    sequences = _sequences()
+    for sampling, item_counts in [('uniform', None), ('popularity', np.arange(101))]:
+        negatives = sample_negative_candidates(sequences, num_users=30, num_items=100, num_negatives=20,
+                                               sampling=sampling, item_counts=item_counts)
+        assert negatives.shape == (30, 20)
+        for user_id, seq in sequences.items():
+            row = negatives[user_id]
+            assert len(set(row.tolist())) == 20
+            assert not set(row.tolist()) & set(seq)
+            assert ((row >= 1) & (row <= 100)).all()
+
+
+def test_negatives_are_reproducible_for_seed():
+    sequences = _sequences()
+    first = sample_negative_candidates(sequences, 30, 100, 10, seed=7)
+    assert np.array_equal(first, sample_negative_candidates(sequences, 30, 100, 10, seed=7))
+    assert not np.array_equal(first, sample_negative_candidates(sequences, 30, 100, 10, seed=8))
+
+
+def test_popularity_sampling_skips_items_without_counts():
+    sequences = {0: [1, 2], 1: [3]}
+    item_counts = np.zeros(11)
+    item_counts[5:] = 1
+    negatives = sample_negative_candidates(sequences, 2, 10, 4, sampling='popularity', item_counts=item_counts)
+    assert (negatives >= 5).all()
+
+
+def test_small_catalog_falls_back_to_repeats_outside_history():
+    """Товаров вне истории меньше N: негативы с повторами, но по-прежнему вне истории."""
+    sequences = {0: [1, 2, 3, 4, 5, 6, 7], 1: [8]}
+    negatives = sample_negative_candidates(sequences, 2, 10, 5)
+    assert set(negatives[0].tolist()) <= {8, 9, 10}
+    assert 8 not in negatives[1]
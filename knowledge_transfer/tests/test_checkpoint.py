@@ -0,0 +1,67 @@
+import os
+
+import pytest
+import torch
+
+from src.checkpoint import AsyncCheckpointWriter
+
+
+def _save_epochs(writer, checkpoint_dir, epochs, best_epochs=()):
+    for epoch in epochs:
+        writer.save({'epoch': torch.tensor(epoch)}, os.path.join(checkpoint_dir, f'model_epoch_{epoch}.pt'),
+                    is_best=epoch in best_epochs)
+    writer.wait()
+    return sorted(int(name[len('model_epoch_'):-len('.pt')]) for name in os.listdir(checkpoint_dir))
+
+
+def test_rotation_keeps_last_checkpoints_and_older_best(tmp_path):
+    writer = AsyncCheckpointWriter(keep_last=2)
+    assert _save_epochs(writer, str(tmp_path), range(1, 7), best_epochs={2}) == [2, 5, 6]
+    writer.close()
+    assert torch.load(tmp_path / 'model_epoch_6.pt')['epoch'].item() == 6
+
+
+def test_rotation_drops_previous_best_when_a_newer_one_appears(tmp_path):
+    writer = AsyncCheckpointWriter(keep_last=1)
+    assert _save_epochs(writer, str(tmp_path), range(1, 6), best_epochs={2, 4}) == [4, 5]
+    writer.close()
+
+
+def test_keep_last_one_keeps_latest_best(tmp_path):
+    writer = AsyncCheckpointWriter(keep_last=1)
+    assert _save_epochs(writer, str(tmp_path), range(1, 4), best_epochs={3}) == [3]
+    writer.close()
+
+
+def test_keep_last_none_keeps_all(tmp_path):
+    writer = AsyncCheckpointWriter()
+    assert _save_epochs(writer, str(tmp_path), range(1, 5)) == [1, 2, 3, 4]
+    writer.close()
+
+
+@pytest.mark.parametrize('keep_last', [0, -1])
+def test_keep_last_below_one_is_rejected(keep_last):
+    with pytest.raises(ValueError):
+        AsyncCheckpointWriter(keep_last=keep_last)
+
+
+def test_submit_is_outside_rotation_and_snapshots_state(tmp_path):
+    """submit не ротируется, а записывается снимок: изменение тензора после вызова не попадает в файл."""
+    writer = AsyncCheckpointWriter(keep_last=1)
+    weights = torch.zeros(3)
+    writer.submit({'weights': weights}, str(tmp_path / 'best' / 'model.pt'))
+    weights += 1
+    _save_epochs(writer, str(tmp_path / 'epochs'), range(1, 3))
+    writer.close()
+    assert torch.equal(torch.load(tmp_path / 'best' / 'model.pt')['weights'], torch.zeros(3))
+    assert os.listdir(tmp_path / 'epochs') == ['model_epoch_2.pt']
+    assert not [name for name in os.listdir(tmp_path / 'best') if name.endswith('.tmp')]
+
+
+def test_write_errors_are_raised_from_wait(tmp_path):
+    (tmp_path / 'file').write_text('')
+    writer = AsyncCheckpointWriter()
+    writer.submit({'x': torch.zeros(1)}, str(tmp_path / 'file' / 'model.pt'))
+    with pytest.raises(OSError):
+        writer.wait()
+    writer.close()
@@ -0,0 +1,49 @@
+import pytest
+import torch
+from torch import nn
+
+from src.checkpoint import AsyncCheckpointWriter
+from src.early_stopping import EarlyStopping
+
+
+def _run(early_stopping, model, values, metric='NDCG@10'):
+    """Подаёт значения метрики по эпохам; веса модели на эпохе e заполнены числом e. Возвращает эпоху остановки."""
+    for epoch, value in enumerate(values, start=1):
+        nn.init.constant_(model.weight, float(epoch))
+        early_stopping.step({metric: value}, model, epoch)
+        if early_stopping.should_stop():
+            return epoch
+    return None
+
+
+def test_stops_after_patience_and_restores_best_weights():
+    model = nn.Linear(2, 2)
+    early_stopping = EarlyStopping('NDCG@10', patience=2, min_delta=0.01)
+    # 0.305 - улучшение меньше min_delta, не считается
+    assert _run(early_stopping, model, [0.1, 0.3, 0.305, 0.2, 0.5]) == 4
+    assert early_stopping.best_epoch == 2
+
+    early_stopping.restore(model)
+    assert torch.equal(model.weight, torch.full((2, 2), 2.0))
+
+
+def test_loss_metrics_are_minimized():
+    early_stopping = EarlyStopping('loss_recsys')
+    _run(early_stopping, nn.Linear(2, 2), [3.0, 2.0, 2.5], metric='loss_recsys')
+    assert early_stopping.best_epoch == 2 and not early_stopping.should_stop()
+
+
+def test_disk_storage_with_writer(tmp_path):
+    model = nn.Linear(2, 2)
+    writer = AsyncCheckpointWriter()
+    early_stopping = EarlyStopping('NDCG@10', storage='disk', best_path=str(tmp_path / 'best.pt'), writer=writer)
+    _run(early_stopping, model, [0.2, 0.4, 0.1])
+
+    early_stopping.restore(model)
+    writer.close()
+    assert torch.equal(model.weight, torch.full((2, 2), 2.0))
+
+
+def test_missing_metric_is_an_error():
+    with pytest.raises(ValueError):
+        EarlyStopping('NDCG@10').step({'NDCG@5': 0.1}, nn.Linear(2, 2), 1)
@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from src.history_index import SeenItemIndex, build_history_csr
+
+
+def test_build_history_csr_drops_target_and_duplicates():
+    sequences = {0: [3, 1, 3, 2], 2: [5, 5, 4], 3: [7]}
+    indptr, indices = build_history_csr(sequences, num_users=4)
+
+    rows = {user_id: indices[indptr[user_id]:indptr[user_id + 1]].tolist() for user_id in range(4)}
+    assert rows == {0: [1, 3], 1: [], 2: [5], 3: []}
+
+
+def test_mask_logits_masks_history_except_target():
+    sequences = {0: [1, 2, 3, 4], 1: [5, 2, 5, 2], 2: [6]}
+    seen_items = SeenItemIndex(*build_history_csr(sequences, num_users=3), device=torch.device('cpu'))
+
+    # Батч в другом порядке, чем user_id; цель пользователя 1 (товар 2) есть в его истории
+    user_ids = torch.tensor([1, 2, 0])
+    targets = torch.tensor([2, 6, 4])
+    logits = torch.zeros(3, 8)
+    seen_items.mask_logits(logits, user_ids, targets)
+
+    masked = torch.isinf(logits)
+    expected = np.zeros((3, 8), dtype=bool)
+    expected[0, [5]] = True
+    expected[2, [1, 2, 3]] = True
+    assert torch.equal(masked, torch.from_numpy(expected))
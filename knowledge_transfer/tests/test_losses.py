@@ -0,0 +1,94 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from src.losses import SampledRecsysLoss
+
+
+def _embeddings(num_items=10, hidden_units=4, bias=True):
+    torch.manual_seed(0)
+    weight = torch.randn(num_items + 1, hidden_units)
+    bias = torch.randn(num_items + 1) if bias else None
+    return weight, bias
+
+
+def _loss_with_negatives(loss_type, weight, bias, negatives, **kwargs):
+    loss = SampledRecsysLoss(loss_type, lambda: (weight, bias), item_num=weight.size(0) - 1,
+                             num_negatives=len(negatives), **kwargs)
+    loss._sample_negatives = lambda device: torch.tensor(negatives, device=device)
+    return loss
+
+
+def test_sampled_softmax_masks_accidental_hits():
+    """Негатив, совпавший с целью строки, не входит в её softmax; для других строк он обычный негатив."""
+    weight, bias = _embeddings()
+    hidden = torch.randn(2, 4)
+    targets = torch.tensor([3, 5])
+    negatives = [3, 7, 9]
+    loss = _loss_with_negatives('uniform', weight, bias, negatives)(hidden, targets)
+
+    scores = hidden @ weight.T + bias
+    expected = torch.stack([
+        F.cross_entropy(scores[0, [3, 7, 9]].unsqueeze(0), torch.tensor([0])),
+        F.cross_entropy(scores[1, [5, 3, 7, 9]].unsqueeze(0), torch.tensor([0])),
+    ]).mean()
+    assert torch.allclose(loss, expected, atol=1e-6)
+
+
+def test_sampled_softmax_ignores_padding_targets():
+    weight, bias = _embeddings()
+    hidden = torch.randn(3, 4)
+    loss_fn = _loss_with_negatives('uniform', weight, bias, [2, 4])
+    loss = loss_fn(hidden, torch.tensor([0, 6, 0]))
+    assert torch.allclose(loss, loss_fn(hidden[1:2], torch.tensor([6])))
+    assert loss_fn(hidden, torch.zeros(3, dtype=torch.long)).item() == 0.0
+
+
+def test_popularity_loss_applies_log_q_correction():
+    """Из логитов позитива и негативов вычитается log(num_negatives * Q(item)), Q - сглаженная популярность."""
+    weight, bias = _embeddings(bias=False)
+    item_counts = [0, 50, 1, 3, 0, 10, 2, 7, 1, 20, 5]
+    hidden = torch.randn(2, 4)
+    targets = torch.tensor([1, 8])
+    negatives = [9, 2, 5, 9]
+    loss = _loss_with_negatives('popularity', weight, None, negatives, item_counts=item_counts)(hidden, targets)
+
+    probs = torch.tensor(item_counts, dtype=torch.float) + 1
+    probs[0] = 0
+    probs = probs / probs.sum()
+    log_q = torch.log(probs) + math.log(len(negatives))
+    scores = hidden @ weight.T - log_q
+    expected = F.cross_entropy(torch.cat([scores.gather(1, targets.view(-1, 1)), scores[:, negatives]], dim=1),
+                               torch.zeros(2, dtype=torch.long))
+    assert torch.allclose(loss, expected, atol=1e-6)
+
+
+def test_in_batch_loss_applies_log_q_over_unique_targets():
+    weight, bias = _embeddings()
+    item_counts = [0] + list(range(1, 11))
+    hidden = torch.randn(4, 4)
+    targets = torch.tensor([4, 2, 4, 9])
+    loss = SampledRecsysLoss('in_batch', lambda: (weight, bias), item_num=10, item_counts=item_counts)(hidden, targets)
+
+    probs = torch.tensor(item_counts, dtype=torch.float) + 1
+    probs[0] = 0
+    probs = probs / probs.sum()
+    candidates = torch.tensor([2, 4, 9])
+    logits = hidden @ weight[candidates].T + bias[candidates] - torch.log(probs[candidates])
+    expected = F.cross_entropy(logits, torch.tensor([1, 0, 1, 2]))
+    assert torch.allclose(loss, expected, atol=1e-6)
+
+
+def test_gbce_zeroes_accidental_hits():
+    """В gBCE попадание цели в негативы не даёт слагаемого отрицательного класса."""
+    weight, bias = _embeddings()
+    hidden = torch.randn(1, 4)
+    targets = torch.tensor([3])
+    with_hit = _loss_with_negatives('gbce', weight, bias, [3, 6])(hidden, targets)
+    without_hit = _loss_with_negatives('gbce', weight, bias, [6, 6])(hidden, targets)
+
+    neg_score = (hidden @ weight[6] + bias[6]).squeeze()
+    neg_term = F.binary_cross_entropy_with_logits(neg_score, torch.tensor(0.0))
+    # Без попадания негатив 6 учтён дважды, с попаданием - один раз; параметры gBCE одинаковы (num_negatives=2)
+    assert torch.allclose(without_hit - with_hit, neg_term, atol=1e-6)
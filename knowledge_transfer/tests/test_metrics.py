@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+from src.history_index import SeenItemIndex, build_history_csr
+from src.metrics import RankingMetrics, streaming_target_ranks, candidate_scores
+
+
+def _dense_logits(hidden, weight, bias):
+    logits = hidden @ weight.T
+    if bias is not None:
+        logits = logits + bias
+    logits[:, 0] = -float('inf')
+    return logits
+
+
+def test_target_ranks_match_dense_topk():
+    """Без ничьих ранг цели совпадает с её позицией в полной сортировке torch.topk, HitRate@k - с попаданием в top-k."""
+    torch.manual_seed(0)
+    logits = torch.randn(16, 50)
+    targets = torch.randint(1, 50, (16,))
+    ranks = RankingMetrics.target_ranks(logits, targets)
+
+    order = torch.topk(logits, logits.size(1), dim=1).indices
+    expected = (order == targets.view(-1, 1)).float().argmax(dim=1) + 1
+    assert torch.equal(ranks, expected)
+
+    metrics = RankingMetrics([1, 5, 10])
+    metrics.update_from_logits(logits, targets)
+    result = metrics.compute()
+    for k in [1, 5, 10]:
+        in_top_k = (torch.topk(logits, k, dim=1).indices == targets.view(-1, 1)).any(dim=1)
+        assert np.isclose(result[f'HitRate@{k}'], in_top_k.float().mean().item())
+
+
+def test_target_ranks_count_ties_against_target():
+    logits = torch.tensor([[0.0, 1.0, 1.0, 1.0, 0.5],
+                           [0.0, 2.0, 1.0, 1.0, 1.0]])
+    ranks = RankingMetrics.target_ranks(logits, torch.tensor([2, 4]))
+    assert ranks.tolist() == [3, 4]
+
+
+def test_nan_target_gets_worst_rank():
+    """NaN-скор цели (разошедшаяся модель) даёт худший ранг и нулевые метрики, а не ранг 1."""
+    logits = torch.randn(3, 20)
+    logits[1, 7] = float('nan')
+    ranks = RankingMetrics.target_ranks(logits, torch.tensor([1, 7, 2]))
+    assert ranks[1].item() == 20
+
+    metrics = RankingMetrics([5, 10])
+    metrics.update_from_logits(torch.full((4, 20), float('nan')), torch.tensor([1, 2, 3, 4]))
+    assert all(value == 0.0 for value in metrics.compute().values())
+
+
+def test_streaming_ranks_match_dense_ranks():
+    torch.manual_seed(0)
+    hidden = torch.randn(8, 6)
+    weight = torch.randn(31, 6)
+    targets = torch.randint(1, 31, (8,))
+    for bias in [None, torch.randn(31)]:
+        expected = RankingMetrics.target_ranks(_dense_logits(hidden, weight, bias), targets)
+        for chunk_size in [1, 7, 31, 100]:
+            ranks = streaming_target_ranks(hidden, weight, bias, targets, chunk_size)
+            assert torch.equal(ranks, expected), chunk_size
+
+
+def test_streaming_ranks_with_seen_item_filtering_match_masked_dense_ranks():
+    """Поправка correct_ranks после блочного скоринга равна рангам по логитам с маской истории."""
+    torch.manual_seed(1)
+    num_items = 40
+    sequences = {user_id: list(np.random.default_rng(user_id).integers(1, num_items + 1, 12)) for user_id in range(6)}
+    # Цель пользователя 0 встречается и в его истории: она не фильтруется
+    sequences[0].append(sequences[0][0])
+    indptr, indices = build_history_csr(sequences, num_users=6)
+    seen_items = SeenItemIndex(indptr, indices, torch.device('cpu'))
+
+    user_ids = torch.tensor([3, 0, 5, 1])
+    targets = torch.tensor([sequences[user_id][-1] for user_id in user_ids.tolist()])
+    hidden = torch.randn(4, 8)
+    weight = torch.randn(num_items + 1, 8)
+    bias = torch.randn(num_items + 1)
+
+    logits = seen_items.mask_logits(_dense_logits(hidden, weight, bias), user_ids, targets)
+    expected = RankingMetrics.target_ranks(logits, targets)
+    ranks = streaming_target_ranks(hidden, weight, bias, targets, chunk_size=9)
+    ranks = seen_items.correct_ranks(ranks, hidden, weight, bias, user_ids, targets)
+    assert torch.equal(ranks, expected)
+
+
+def test_candidate_scores_match_dense_gather():
+    torch.manual_seed(2)
+    hidden = torch.randn(5, 4)
+    weight = torch.randn(21, 4)
+    bias = torch.randn(21)
+    candidates = torch.randint(1, 21, (5, 6))
+    expected = (hidden @ weight.T + bias).gather(1, candidates)
+    assert torch.allclose(candidate_scores(hidden, weight, bias, candidates), expected, atol=1e-6)
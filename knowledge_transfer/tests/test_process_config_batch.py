@@ -0,0 +1,74 @@
+import os
+import json
+import pickle
+import random
+import socket
+
+import yaml
+
+from src.process_config_batch import run_sweep
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _write_dataset(data_dir, num_users=40, num_items=30):
+    rng = random.Random(0)
+    train = {u: [rng.randint(1, num_items) for _ in range(rng.randint(3, 10))] for u in range(num_users)}
+    valid = {u: seq + [rng.randint(1, num_items)] for u, seq in train.items()}
+    test = {u: seq + [rng.randint(1, num_items)] for u, seq in valid.items()}
+    mappings = ({f'u{u}': u for u in range(num_users)}, {f'i{i}': i for i in range(1, num_items + 1)})
+    for name, obj in [('train', train), ('valid', valid), ('test', test), ('mappings', mappings),
+                      ('counts', (num_users, num_items))]:
+        with open(os.path.join(data_dir, f'{name}.pkl'), 'wb') as f:
+            pickle.dump(obj, f)
+
+
+def _write_config(path, data_dir, model_dir, name, **sections):
+    config = {
+        'seed': 1,
+        'experiment_name': name,
+        'model': {'model_name': 'SASRec', 'maxlen': 10, 'hidden_units': 8, 'num_blocks': 1, 'num_heads': 1,
+                  'dropout_rate': 0.1},
+        'training': {'batch_size': 16, 'epochs': 1, 'learning_rate': 1e-3, 'eval_every': 1, 'model_dir': model_dir},
+        'data': {key: os.path.join(data_dir, f'{file}.pkl') for key, file in [
+            ('profile_train_sequences', 'train'), ('finetune_train_sequences', 'train'),
+            ('valid_sequences', 'valid'), ('test_sequences', 'test'), ('mappings', 'mappings'),
+            ('counts', 'counts')]},
+    }
+    for section, values in sections.items():
+        config.setdefault(section, {}).update(values)
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f)
+    return str(path)
+
+
+def test_run_sweep_jobs_can_start_child_processes(tmp_path, monkeypatch):
+    """Задачи перебора сами запускают процессы: воркеры DataLoader и распределённое обучение."""
+    monkeypatch.setenv('MLFLOW_TRACKING_URI', (tmp_path / 'mlruns').as_uri())
+    monkeypatch.setenv('MLFLOW_ALLOW_FILE_STORE', 'true')
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    _write_dataset(str(data_dir))
+
+    config_files = [
+        _write_config(tmp_path / 'loader_workers.yaml', str(data_dir), str(tmp_path / 'models_workers'),
+                      'loader_workers', dataloader={'num_workers': 1}),
+        _write_config(tmp_path / 'distributed.yaml', str(data_dir), str(tmp_path / 'models_distributed'),
+                      'distributed', distributed={'world_size': 2, 'master_port': _free_port(),
+                                                  'threads_per_process': 1}),
+    ]
+    report_path = tmp_path / 'report.jsonl'
+
+    results = run_sweep(config_files, num_workers=1, threads_per_job=1, resume=False, report_path=str(report_path))
+
+    assert sorted(result['config'] for result in results) == sorted(config_files)
+    for result in results:
+        assert result['status'] == 'done', result['error']
+    assert os.path.exists(tmp_path / 'models_workers' / 'SASRec_model.pt')
+    assert os.path.exists(tmp_path / 'models_distributed' / 'SASRec_model.pt')
+    with open(report_path, encoding='utf-8') as f:
+        assert len([json.loads(line) for line in f]) == 2
@@ -3,6 +3,7 @@ import yaml
 import argparse
 from src.llm import Embedder, OpenAIEmbedder, GigaChatEmbedder, E5Embedder, KaLMEmbedder, E5SmallEmbedder
 from src.profile_generator.profile_generator import ProfileGenerator
+from src.utils import save_embeddings_npy
 
 
 def parse_args():
@@ -17,7 +18,10 @@ def parse_args():
         help="Path to the json with descriptions",
     )
     parser.add_argument(
-        "--embeddings-path", type=str, required=True, help="Path to save embeddings"
+        "--embeddings-path",
+        type=str,
+        required=True,
+        help="Path to save embeddings: .npy for the binary format (+ .ids.json), otherwise JSON",
     )
     return parser.parse_args()
 
@@ -49,8 +53,11 @@ def main():
 
     embeddings = ProfileGenerator.generate_embeddings(user2descripton, embedder)
     # Save embeddings to file
-    with open(args.embeddings_path, "w", encoding="utf-8") as f:
-        json.dump(embeddings, f)
+    if args.embeddings_path.endswith(".npy"):
+        save_embeddings_npy(embeddings, args.embeddings_path)
+    else:
+        with open(args.embeddings_path, "w", encoding="utf-8") as f:
+            json.dump(embeddings, f)
 
 
 if __name__ == "__main__":
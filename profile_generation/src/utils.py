@@ -1,9 +1,8 @@
+import os
 import pandas as pd
 import json
-import umap
-import matplotlib.pyplot as plt
 import numpy as np
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 
 def preprocess_null_field(field: Any) -> str:
@@ -50,6 +49,20 @@ def save_json(data: Dict, file_path: str) -> None:
         json.dump(data, f, ensure_ascii=False)
 
 
+def save_embeddings_npy(embeddings: Dict[str, List[float]], file_path: str) -> None:
+    """Saves embeddings in the binary format memory-mapped by knowledge_transfer.
+
+    Writes a float32 matrix to `<name>.npy` and the user IDs in row order to `<name>.ids.json`.
+
+    Args:
+        embeddings (Dict[str, List[float]]): Mapping user_id -> embedding.
+        file_path (str): The path to the output .npy file.
+    """
+    np.save(file_path, np.asarray(list(embeddings.values()), dtype=np.float32))
+    with open(os.path.splitext(file_path)[0] + ".ids.json", "w", encoding="utf-8") as f:
+        json.dump([str(user_id) for user_id in embeddings.keys()], f)
+
+
 def visualize_embeddings(
     json_file_path: str, output_file_path="umap.png", annotate_points=False
 ):
@@ -82,6 +95,10 @@ def visualize_embeddings(
 
     embeddings_np = np.array(embeddings)
 
+    # Plotting-only dependencies: importing src.utils must not require them
+    import umap
+    import matplotlib.pyplot as plt
+
     reducer = umap.UMAP(n_components=2)
     reduced_embeddings = reducer.fit_transform(embeddings_np)
 